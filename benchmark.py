@@ -0,0 +1,364 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from pathlib import Path
+
+import duckdb
+import numpy as np
+import pandas as pd
+from geopy.distance import geodesic
+
+import bulk_sample_data
+from user_report.assets import iter_property_frames, monthly_partition_def
+from user_report.distance import distance_miles
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def random_reservations(num_rows, seed=0):
+    # Guests scattered up to ~1000 miles around properties, like sample_data.py
+    rng = np.random.default_rng(seed)
+    lat = rng.uniform(25, 48, num_rows)
+    lon = rng.uniform(-123, -73, num_rows)
+    return pd.DataFrame(
+        {
+            "lat": lat,
+            "lon": lon,
+            "lat_guest": lat + rng.uniform(-10, 10, num_rows),
+            "lon_guest": lon + rng.uniform(-10, 10, num_rows),
+        }
+    )
+
+
+def calc_dist(row):
+    # The original per-row implementation from monthly_reservations
+    return geodesic(
+        (row["lat"], row["lon"]), (row["lat_guest"], row["lon_guest"])
+    ).miles
+
+
+def benchmark_distance(num_rows, seed=0):
+    df = random_reservations(num_rows, seed)
+    columns = [df[c].to_numpy() for c in ["lat", "lon", "lat_guest", "lon_guest"]]
+
+    baseline, baseline_seconds = timed(df.apply, calc_dist, axis=1)
+    print(f"{'method':<12}{'seconds':>10}{'rows/sec':>14}{'max err (mi)':>16}")
+    print(
+        f"{'apply':<12}{baseline_seconds:>10.3f}{num_rows / baseline_seconds:>14,.0f}"
+    )
+    for method in ["haversine", "geodesic"]:
+        result, seconds = timed(distance_miles, *columns, method=method)
+        error = np.abs(result - baseline.to_numpy()).max()
+        print(f"{method:<12}{seconds:>10.3f}{num_rows / seconds:>14,.0f}{error:>16.6g}")
+
+
+def random_property_analytics(num_properties, num_months=5, seed=0):
+    rng = np.random.default_rng(seed)
+    month_ends = pd.date_range("2023-04-01", periods=num_months, freq="MS", tz="UTC")
+    df = pd.DataFrame(
+        {
+            "property_id": np.repeat(np.arange(num_properties), num_months),
+            "month_end": np.tile(month_ends, num_properties),
+            "total_revenue": rng.integers(
+                100_000, 5_000_000, num_properties * num_months
+            ),
+        }
+    )
+    # Partitions arrive month by month, not grouped by property
+    return df.sample(frac=1, random_state=seed, ignore_index=True)
+
+
+def iter_property_frames_masked(property_analytics):
+    # The original boolean mask per property from historical_bar_charts
+    for property_id in property_analytics["property_id"].unique():
+        yield property_id, property_analytics[
+            property_analytics["property_id"] == property_id
+        ].sort_values(by="month_end")
+
+
+def benchmark_groupby(property_counts, seed=0):
+    def consume(frames):
+        for _, property_data in frames:
+            property_data.iloc[-1]
+
+    print(f"{'properties':>12}{'rows':>10}{'method':>10}{'seconds':>10}{'ns/row':>10}")
+    for num_properties in property_counts:
+        df = random_property_analytics(num_properties, seed=seed)
+        methods = {"sliced": iter_property_frames}
+        # The masked path is quadratic, keep it to sizes that finish
+        if num_properties <= 5_000:
+            methods["masked"] = iter_property_frames_masked
+        for method, iter_frames in methods.items():
+            _, seconds = timed(consume, iter_frames(df))
+            print(
+                f"{num_properties:>12,}{len(df):>10,}{method:>10}"
+                f"{seconds:>10.3f}{seconds / len(df) * 1e9:>10,.0f}"
+            )
+
+
+PIPELINE_STEPS = [
+    "monthly_reservations",
+    "property_analytics",
+    "market_analytics",
+    "historical_bar_charts",
+    "emails_to_send",
+    "send_emails",
+]
+# historical_bar_charts reads the four partitions before the one benchmarked
+HISTORY_PARTITIONS = 4
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_pipeline_step(workdir, step, partition_keys):
+    # Runs in a fresh process, so peak RSS belongs to this step alone. The
+    # resources in user_report.defs use paths relative to the workdir.
+    os.chdir(workdir)
+    from dagster import materialize
+
+    from user_report import all_assets, defs
+
+    start = time.perf_counter()
+    # The local EmailClient prints every email it would send
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for partition_key in partition_keys:
+            if step == "send_emails":
+                defs.get_job_def("send_emails_job").execute_in_process(
+                    partition_key=partition_key
+                )
+            else:
+                materialize(
+                    all_assets,
+                    selection=step.split(","),
+                    partition_key=partition_key,
+                    resources=defs.resources,
+                )
+    return time.perf_counter() - start, peak_rss_mb()
+
+
+def count_step_rows(database, step, month_end):
+    table = "emails_to_send" if step == "send_emails" else step
+    condition = "AND total_revenue_chart IS NOT NULL" if step == "send_emails" else ""
+    with duckdb.connect(database) as conn:
+        return conn.execute(
+            f"SELECT count(*) FROM {table} WHERE month_end = ? {condition}",
+            [month_end],
+        ).fetchone()[0]
+
+
+def benchmark_pipeline_scale(scale, seed, end_date, partition_key):
+    partition_keys = monthly_partition_def.get_partition_keys()
+    index = partition_keys.index(partition_key)
+    history = partition_keys[max(0, index - HISTORY_PARTITIONS) : index]
+    month_end = str(
+        monthly_partition_def.time_window_for_partition_key(partition_key).end
+    )
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as workdir:
+        database = str(Path(workdir) / "myvacation.duckdb")
+        subprocess.run(
+            [sys.executable, str(Path(__file__).parent / "database.py")],
+            cwd=workdir,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        bulk_sample_data.load(database, scale, seed, 6 * 30, end_date, 10_000)
+
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            pool.submit(
+                run_pipeline_step,
+                workdir,
+                "monthly_reservations,property_analytics",
+                history,
+            ).result()
+        for step in PIPELINE_STEPS:
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                seconds, rss = pool.submit(
+                    run_pipeline_step, workdir, step, [partition_key]
+                ).result()
+            rows = count_step_rows(database, step, month_end)
+            results.append(
+                {
+                    "scale": scale,
+                    "asset": step,
+                    "seconds": seconds,
+                    "peak_rss_mb": rss,
+                    "rows": rows,
+                    "rows_per_second": rows / seconds if seconds else 0.0,
+                }
+            )
+    return results
+
+
+def compare_pipeline(results, baseline, threshold):
+    # A step regresses when its time or peak memory grows by more than
+    # threshold relative to the baseline run at the same scale
+    previous = {(r["scale"], r["asset"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get((result["scale"], result["asset"]))
+        if before is None:
+            continue
+        for metric in ["seconds", "peak_rss_mb"]:
+            if result[metric] > before[metric] * (1 + threshold):
+                regressions.append(
+                    f"scale {result['scale']:g} {result['asset']}: {metric} "
+                    f"{before[metric]:.2f} -> {result[metric]:.2f}"
+                )
+    return regressions
+
+
+def benchmark_pipeline(
+    scales, seed, end_date, partition_key, output, baseline, threshold
+):
+    results = []
+    print(
+        f"{'scale':>8}{'asset':>24}{'seconds':>10}{'rss (MB)':>10}{'rows':>10}{'rows/sec':>12}"
+    )
+    for scale in scales:
+        for result in benchmark_pipeline_scale(scale, seed, end_date, partition_key):
+            results.append(result)
+            print(
+                f"{scale:>8g}{result['asset']:>24}{result['seconds']:>10.2f}"
+                f"{result['peak_rss_mb']:>10.0f}{result['rows']:>10,}"
+                f"{result['rows_per_second']:>12,.0f}"
+            )
+
+    report = {
+        "seed": seed,
+        "end_date": str(end_date),
+        "partition": partition_key,
+        "python": sys.version.split()[0],
+        "results": results,
+    }
+    if output:
+        Path(output).write_text(json.dumps(report, indent=2))
+
+    if baseline:
+        regressions = compare_pipeline(
+            results, json.loads(Path(baseline).read_text()), threshold
+        )
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+def import_times(module):
+    # Self and cumulative import time in seconds of every module loaded by
+    # `import module` in a fresh interpreter, from python -X importtime
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|")
+        times[name.strip()] = (int(self_us) / 1e6, int(cumulative_us) / 1e6)
+    return times
+
+
+def benchmark_imports(module, budget, repeat, top):
+    # Loading the code location should stay cheap, since dagster dev, every
+    # run worker and every schedule tick import it. The fastest of `repeat`
+    # runs is reported, so a cold filesystem cache doesn't count.
+    times = min(
+        (import_times(module) for _ in range(repeat)),
+        key=lambda times: times[module][1],
+    )
+    total = times[module][1]
+
+    # Self time summed per top level package, so every module is counted once
+    packages = {}
+    for name, (self_seconds, _) in times.items():
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0.0) + self_seconds
+    print(f"{'package':<32}{'ms':>10}")
+    for package, seconds in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        print(f"{package:<32}{seconds * 1000:>10.1f}")
+
+    print(f"\n{'module':<32}{'cumulative ms':>14}")
+    for name, (_, cumulative) in sorted(times.items()):
+        if name == module or name.startswith(f"{module}."):
+            print(f"{name:<32}{cumulative * 1000:>14.1f}")
+
+    print(f"\nimport {module}: {total * 1000:.0f} ms (budget {budget * 1000:.0f} ms)")
+    if total > budget:
+        print(f"OVER BUDGET by {(total - budget) * 1000:.0f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    distance_parser = subparsers.add_parser("distance")
+    distance_parser.add_argument("--rows", type=int, default=100_000)
+    distance_parser.add_argument("--seed", type=int, default=0)
+
+    groupby_parser = subparsers.add_parser("groupby")
+    groupby_parser.add_argument(
+        "--properties", type=int, nargs="+", default=[1_000, 5_000, 20_000, 80_000]
+    )
+    groupby_parser.add_argument("--seed", type=int, default=0)
+
+    pipeline_parser = subparsers.add_parser("pipeline")
+    pipeline_parser.add_argument("--scales", type=float, nargs="+", default=[0.2, 1])
+    pipeline_parser.add_argument("--seed", type=int, default=0)
+    # Fixed dates keep results comparable between runs
+    pipeline_parser.add_argument(
+        "--end-date", type=date.fromisoformat, default="2023-09-01"
+    )
+    pipeline_parser.add_argument("--partition", default="2023-08-01")
+    pipeline_parser.add_argument("--output", help="Write the results as JSON")
+    pipeline_parser.add_argument("--baseline", help="Compare against a JSON result")
+    pipeline_parser.add_argument("--threshold", type=float, default=0.25)
+
+    imports_parser = subparsers.add_parser("imports")
+    imports_parser.add_argument("--module", default="user_report")
+    imports_parser.add_argument(
+        "--budget", type=float, default=1.0, help="Seconds allowed for the import"
+    )
+    imports_parser.add_argument("--repeat", type=int, default=3)
+    imports_parser.add_argument("--top", type=int, default=15)
+
+    args = parser.parse_args()
+    if args.benchmark == "distance":
+        benchmark_distance(args.rows, args.seed)
+    elif args.benchmark == "groupby":
+        benchmark_groupby(args.properties, args.seed)
+    elif args.benchmark == "pipeline":
+        benchmark_pipeline(
+            args.scales,
+            args.seed,
+            args.end_date,
+            args.partition,
+            args.output,
+            args.baseline,
+            args.threshold,
+        )
+    elif args.benchmark == "imports":
+        benchmark_imports(args.module, args.budget, args.repeat, args.top)
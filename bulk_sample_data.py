@@ -0,0 +1,221 @@
+import argparse
+import time
+from datetime import date
+
+import duckdb
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from faker import Faker
+
+from sample_data import num_properties as base_num_properties, submarkets
+from user_report.distance import destination
+
+# Generates the same tables as sample_data.py, but a whole column at a time with
+# NumPy and loaded into DuckDB as Arrow tables, so production sized datasets
+# can be built in minutes. Properties are generated in chunks to keep memory
+# bounded, and the same --seed and --chunk-size always produce the same data.
+
+NAME_POOL_SIZE = 1000
+MAX_RESERVATION_DAYS = 6
+MAX_BOOKING_LEAD_DAYS = 60
+RATED_SHARE = 0.6
+
+
+def name_pools(seed):
+    fake = Faker()
+    fake.seed_instance(seed)
+    first_names = np.array([fake.first_name() for _ in range(NAME_POOL_SIZE)])
+    last_names = np.array([fake.last_name() for _ in range(NAME_POOL_SIZE)])
+    streets = np.array([fake.street_name() for _ in range(NAME_POOL_SIZE)])
+    return first_names, last_names, streets
+
+
+def generate_properties(rng, property_ids, pools):
+    first_names, last_names, streets = pools
+    n = len(property_ids)
+    market = rng.integers(0, len(submarkets), n)
+    market_names, market_lat, market_lon, cities, states, zipcodes = (
+        np.array(column) for column in zip(*submarkets)
+    )
+
+    first = first_names[rng.integers(0, NAME_POOL_SIZE, n)]
+    last = last_names[rng.integers(0, NAME_POOL_SIZE, n)]
+    ids = pc.cast(pa.array(property_ids), pa.string())
+    hosts = pa.table(
+        {
+            "id": pa.array(property_ids, pa.int32()),
+            "name": pc.binary_join_element_wise(first, last, " "),
+            "email": pc.binary_join_element_wise(
+                pc.utf8_lower(pa.array(first)),
+                ".",
+                pc.utf8_lower(pa.array(last)),
+                ids,
+                "@example.com",
+                "",
+            ),
+        }
+    )
+
+    # Within a mile of the submarket's center, like sample_data.py
+    lat, lon = destination(
+        market_lat[market].astype(np.float64),
+        market_lon[market].astype(np.float64),
+        rng.uniform(0, 360, n),
+        rng.uniform(0, 1, n),
+    )
+    street_numbers = pc.cast(pa.array(rng.integers(1, 10_000, n)), pa.string())
+    address = pc.binary_join_element_wise(
+        pc.binary_join_element_wise(
+            street_numbers, streets[rng.integers(0, NAME_POOL_SIZE, n)], " "
+        ),
+        cities[market],
+        states[market],
+        zipcodes[market],
+        ", ",
+    )
+    properties = pa.table(
+        {
+            "id": pa.array(property_ids, pa.int32()),
+            "address": address,
+            "lat": pa.array(lat, pa.float32()),
+            "lon": pa.array(lon, pa.float32()),
+            "host_id": pa.array(property_ids, pa.int32()),
+            "market_name": market_names[market],
+            "nightly_rate": pa.array(rng.integers(5000, 50001, n), pa.int32()),
+            "max_guests": pa.array(rng.integers(1, 11, n), pa.int32()),
+        }
+    )
+    return hosts, properties
+
+
+def generate_reservations(rng, properties, first_id, start, days):
+    # sample_data.py walks each property day by day, starting a reservation
+    # with the property's occupancy probability and skipping to its end. The
+    # idle days before each reservation are therefore geometric, so every
+    # property's timeline is the cumulative sum of idle days and lengths.
+    # A property can fit at most `days` reservations.
+    n = properties.num_rows
+    occupancy = rng.uniform(0.3, 0.95, n)
+    nearby_rate = rng.uniform(0.4, 0.8, n)
+
+    idle = rng.geometric(occupancy[:, None], (n, days)) - 1
+    length = rng.integers(1, MAX_RESERVATION_DAYS + 1, (n, days))
+    start_offset = np.cumsum(idle + length, axis=1) - length
+    booked = start_offset < days
+
+    row, _ = np.nonzero(booked)
+    start_offset = start_offset[booked]
+    length = length[booked]
+    count = len(row)
+
+    nightly_rate = properties["nightly_rate"].to_numpy()[row]
+    is_nearby = rng.random(count) < nearby_rate[row]
+    radius = np.where(is_nearby, 100, 1000) * rng.random(count)
+    guest_lat, guest_lon = destination(
+        properties["lat"].to_numpy()[row],
+        properties["lon"].to_numpy()[row],
+        rng.uniform(0, 360, count),
+        radius,
+    )
+
+    ids = np.arange(first_id, first_id + count, dtype=np.int32)
+    start_date = (np.datetime64(start, "D") + start_offset).astype("datetime64[us]")
+    length_days = length.astype("timedelta64[D]")
+    guests = pa.table(
+        {
+            "id": ids,
+            "lat": pa.array(guest_lat, pa.float32()),
+            "lon": pa.array(guest_lon, pa.float32()),
+        }
+    )
+    reservations = pa.table(
+        {
+            "id": ids,
+            "property_id": properties["id"].take(pa.array(row)),
+            "start_date": pa.array(start_date, pa.timestamp("us")),
+            "end_date": pa.array(start_date + length_days, pa.timestamp("us")),
+            "guest_id": ids,
+            "total_cost": pa.array(length * nightly_rate, pa.float32()),
+            "created_at": pa.array(
+                start_date
+                - rng.integers(0, MAX_BOOKING_LEAD_DAYS + 1, count).astype(
+                    "timedelta64[D]"
+                ),
+                pa.timestamp("us"),
+            ),
+        }
+    )
+    # Drawn last, so a seed's other columns match data generated before
+    # ratings were added
+    quality = rng.uniform(3.5, 5, n)
+    stars = np.clip(np.rint(rng.normal(quality[row], 0.7)), 1, 5)
+    is_rated = rng.random(count) < RATED_SHARE
+    reservations = reservations.append_column(
+        "stars", pa.array(stars, pa.float32(), mask=~is_rated)
+    )
+    return guests, reservations
+
+
+def insert(conn, table_name, table):
+    conn.register("chunk", table)
+    try:
+        # By name, so columns with defaults (host.updated_at) can be left out
+        conn.execute(f"INSERT INTO {table_name} BY NAME SELECT * FROM chunk")
+    finally:
+        conn.unregister("chunk")
+
+
+def load(database, scale, seed, days, end_date, chunk_size):
+    num_properties = max(1, round(base_num_properties * scale))
+    start = np.datetime64(end_date, "D") - days
+    pools = name_pools(seed)
+    # Independent generator per chunk, derived from the seed
+    chunk_seeds = np.random.SeedSequence(seed).spawn(-(-num_properties // chunk_size))
+
+    conn = duckdb.connect(database)
+    num_reservations = 0
+    started = time.perf_counter()
+    conn.execute("BEGIN TRANSACTION")
+    for chunk, chunk_seed in enumerate(chunk_seeds):
+        rng = np.random.default_rng(chunk_seed)
+        property_ids = np.arange(
+            chunk * chunk_size, min((chunk + 1) * chunk_size, num_properties)
+        )
+        hosts, properties = generate_properties(rng, property_ids, pools)
+        guests, reservations = generate_reservations(
+            rng, properties, num_reservations + 1, start, days
+        )
+        insert(conn, "host", hosts)
+        insert(conn, "property", properties)
+        insert(conn, "guest", guests)
+        insert(conn, "reservation", reservations)
+        num_reservations += reservations.num_rows
+    conn.execute("COMMIT")
+    conn.close()
+
+    seconds = time.perf_counter() - started
+    print(
+        f"Loaded {num_properties:,} properties and {num_reservations:,} "
+        f"reservations in {seconds:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database", default="myvacation.duckdb")
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help=f"Multiple of sample_data.py's {base_num_properties} properties",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--days", type=int, default=6 * 30)
+    parser.add_argument("--end-date", type=date.fromisoformat, default=date.today())
+    parser.add_argument("--chunk-size", type=int, default=10_000)
+    args = parser.parse_args()
+
+    load(
+        args.database, args.scale, args.seed, args.days, args.end_date, args.chunk_size
+    )
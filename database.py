@@ -9,7 +9,8 @@ conn.execute(
 CREATE TABLE host (
     id INTEGER,
     name VARCHAR,
-    email VARCHAR
+    email VARCHAR,
+    updated_at DATETIME DEFAULT current_timestamp
 );
 """
 )
@@ -47,7 +48,9 @@ CREATE TABLE reservation (
     start_date DATETIME,
     end_date DATETIME,
     guest_id INTEGER,
-    total_cost FLOAT
+    total_cost FLOAT,
+    created_at DATETIME,
+    stars FLOAT
 );
 """
 )
@@ -9,6 +9,8 @@ from geopy.distance import great_circle
 fake = Faker()
 
 num_properties = 250
+# Share of stays the guest rated
+rated_share = 0.6
 
 amenities = [
     "Basketball Court",
@@ -129,6 +131,8 @@ def create_reservations(conn):
         # Calculate the property-specific occupancy rate and nearby guest rate
         property_occupancy = random.uniform(0.3, 0.95)
         nearby_guest_rate = random.uniform(0.4, 0.8)
+        # The average rating guests give the property
+        property_quality = random.uniform(3.5, 5)
 
         while date < today:
             # Decide if there will be a reservation starting on this date
@@ -153,13 +157,23 @@ def create_reservations(conn):
                     is_nearby,
                 )
 
+                # The reservation was booked up to 60 days before it starts
+                created_at = date - timedelta(days=random.randint(0, 60))
+
+                # Most guests rate their stay 1-5 stars
+                stars = (
+                    min(5, max(1, round(random.gauss(property_quality, 0.7))))
+                    if random.random() < rated_share
+                    else "NULL"
+                )
+
                 # Create reservation with the new guest id
                 conn.execute(
                     f"""
                     INSERT INTO reservation 
-                    (id, property_id, start_date, end_date, guest_id, total_cost)
+                    (id, property_id, start_date, end_date, guest_id, total_cost, created_at, stars)
                     VALUES 
-                    ({reservation_id}, {property_id}, '{date.date()}', '{end_date.date()}', {guest_id}, {total_cost})
+                    ({reservation_id}, {property_id}, '{date.date()}', '{end_date.date()}', {guest_id}, {total_cost}, '{created_at}', {stars})
                 """
                 )
 
@@ -174,9 +188,10 @@ def create_reservations(conn):
     conn.execute("COMMIT")
 
 
-# Create a connection to the DuckDB
-conn = duckdb.connect("myvacation.duckdb")
+if __name__ == "__main__":
+    # Create a connection to the DuckDB
+    conn = duckdb.connect("myvacation.duckdb")
 
-# Create amenities and properties
-create_properties_and_hosts(conn, num_properties, amenities, submarkets)
-create_reservations(conn)
+    # Create amenities and properties
+    create_properties_and_hosts(conn, num_properties, amenities, submarkets)
+    create_reservations(conn)
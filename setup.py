@@ -8,6 +8,9 @@ setup(
         "dagster-cloud",
         "dagster-duckdb~=0.20",
         "dagster-duckdb-pandas~=0.20",
+        # ImageFont.load_default(size) needs 10.1
+        "pillow>=10.1",
+        "pyarrow",
         "seaborn~=0.12",
     ],
     extras_require={"dev": ["dagster-webserver", "pytest"]},
@@ -1,17 +1,26 @@
 from dagster import (
     Definitions,
+    FilesystemIOManager,
     load_assets_from_modules,
     ScheduleDefinition,
 )
 
-from dagster_duckdb_pandas import DuckDBPandasIOManager
-
 from . import assets
-from .resources import LocalFileStorage, Database, EmailService
+from .io_managers import DuckDBPandasArrowIOManager
+from .resources import (
+    LocalFileStorage,
+    ChartCache,
+    Database,
+    DeliveryLedger,
+    EmailService,
+    HostCache,
+)
 from .assets import send_emails_job
 
 all_assets = load_assets_from_modules([assets])
-database_io_manager = DuckDBPandasIOManager(database="myvacation.duckdb", schema="main")
+database_io_manager = DuckDBPandasArrowIOManager(
+    database="myvacation.duckdb", schema="main"
+)
 
 send_emails_schedule = ScheduleDefinition(
     job=send_emails_job,
@@ -24,8 +33,14 @@ defs = Definitions(
     schedules=[send_emails_schedule],
     resources={
         "io_manager": database_io_manager,
+        # Intermediate op outputs of send_emails_job, e.g. its shards
+        "fs_io_manager": FilesystemIOManager(),
         "image_storage": LocalFileStorage(dir="charts"),
+        "chart_cache": ChartCache(index_path="charts/chart_cache.json"),
         "database": Database(path="myvacation.duckdb"),
+        "host_cache": HostCache(dir="host_cache"),
+        # Kept in the pipeline's database, next to what it records
+        "delivery_ledger": DeliveryLedger(path="myvacation.duckdb"),
         "email_service": EmailService(
             template_id=123,  # EnvVar("EMAIL_TEMPLATE_ID"),
             sender_email="sender_email",  # EnvVar("EMAIL_SENDER_EMAIL"),
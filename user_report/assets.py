@@ -1,119 +1,626 @@
-from geopy.distance import geodesic
-import base64
-import pandas as pd
-import numpy as np
-from .resources import LocalFileStorage, Database, EmailService
+import functools
+import io
+import itertools
+from typing import List, Optional
+from .resources import (
+    LocalFileStorage,
+    ChartCache,
+    Database,
+    DeliveryLedger,
+    EmailService,
+    HostCache,
+)
 from . import charts
+from .attachments import encode_attachments
+from . import instrumentation, ledger, rollups, watermarks
+
+# pandas, numpy and pyarrow are imported inside the functions that use them,
+# so loading the code location (dagster dev, run workers, schedule ticks)
+# doesn't pay for them. For the same reason assets and ops aren't annotated
+# with DataFrame or Table types: the IO manager stores outputs by their
+# runtime type and loads unannotated inputs as pandas DataFrames.
 
 from dagster import (
     AssetExecutionContext,
+    Config,
+    Failure,
     asset,
     op,
     job,
     AssetIn,
+    DynamicOut,
+    DynamicOutput,
+    In,
+    Nothing,
+    Out,
     TimeWindowPartitionMapping,
+    TimeWindowPartitionsDefinition,
+    MetadataValue,
     MonthlyPartitionsDefinition,
+    OpExecutionContext,
 )
 
 monthly_partition_def = MonthlyPartitionsDefinition(start_date="2023-03-01")
 
+# month_end holds the exclusive end of each monthly window, so shift it back
+# inside the window when the IO manager selects or replaces a partition
+month_end_partition_expr = "month_end - INTERVAL 1 DAY"
+
+# Row order of the stored tables, see io_managers.SortingDbIOManager
+month_end_sort_key = ["month_end", "property_id"]
+
+# Guests travelling at most this many miles count as local reservations
+LOCAL_RESERVATION_MILES = 100
+
+
+# Bind with reservations_params(bounds)
+RESERVATIONS_QUERY = """
+    SELECT
+        r.id,
+        r.property_id,
+        r.guest_id,
+        r.created_at,
+        r.total_cost,
+        date_diff('day', r.start_date, r.end_date) AS nights,
+        r.stars,
+        g.lat AS lat_guest,
+        g.lon AS lon_guest,
+        p.lon,
+        p.lat,
+        p.host_id,
+        p.market_name
+    FROM
+        reservation r
+    LEFT JOIN
+        property p ON r.property_id = p.id
+    LEFT JOIN
+        guest g ON r.guest_id = g.id
+    WHERE r.end_date >= $start AND r.end_date < $end
+"""
+
+
+def reservations_params(bounds):
+    return {"start": str(bounds.start), "end": str(bounds.end)}
+
+
+def window_days(bounds):
+    return (bounds.end - bounds.start).days
+
+
+class MonthlyReservationsConfig(Config):
+    # "geodesic" matches geopy's ellipsoidal distance, "haversine" is faster
+    distance_method: str = "geodesic"
+    # Reservations are read, given their distances and written this many
+    # rows at a time, so the month is never held in memory at once
+    batch_size: int = 1_000_000
+
+
+def distance_schema(schema):
+    # The schema of with_distance's result for reservation rows of schema
+    import pyarrow as pa
+
+    return schema.append(pa.field("dist", pa.float64())).append(
+        pa.field("month_end", pa.timestamp("ns", tz="UTC"))
+    )
+
+
+def with_distance(reservations, bounds, distance_method):
+    # Adds the guest's travel distance and the partition's month_end to
+    # Arrow reservation rows
+    import numpy as np
+    import pandas as pd
+    import pyarrow as pa
+    from .distance import distance_miles
+
+    with instrumentation.span("distance", rows=reservations.num_rows):
+        dist = distance_miles(
+            reservations["lat"].to_numpy(),
+            reservations["lon"].to_numpy(),
+            reservations["lat_guest"].to_numpy(),
+            reservations["lon_guest"].to_numpy(),
+            method=distance_method,
+        )
+    month_end = pd.Timestamp(bounds.end).tz_convert("UTC").tz_localize(None)
+    return reservations.append_column("dist", pa.array(dist)).append_column(
+        "month_end",
+        pa.array(
+            np.full(reservations.num_rows, month_end.to_datetime64()),
+            type=pa.timestamp("ns", tz="UTC"),
+        ),
+    )
+
 
 @asset(
     partitions_def=monthly_partition_def,
-    metadata={"partition_expr": "month_end"},
+    metadata={
+        "partition_expr": month_end_partition_expr,
+        "sort_by": month_end_sort_key,
+    },
 )
 def monthly_reservations(
-    context: AssetExecutionContext, database: Database
-) -> pd.DataFrame:
-    bounds = context.partition_time_window
-    results = database.query(
+    context: AssetExecutionContext,
+    config: MonthlyReservationsConfig,
+    database: Database,
+):
+    import pyarrow as pa
+
+    with instrumentation.instrument(context):
+        # Stays in Arrow end to end, the rows are never converted to pandas.
+        # Returned as a record batch reader that the IO manager writes batch
+        # by batch, so each batch gets its distances only when it is written.
+        bounds = context.partition_time_window
+        batches = database.query_batches(
+            RESERVATIONS_QUERY,
+            reservations_params(bounds),
+            batch_size=config.batch_size,
+        )
+        return pa.RecordBatchReader.from_batches(
+            distance_schema(batches.schema),
+            (
+                batch_with_distance
+                for batch in batches
+                for batch_with_distance in with_distance(
+                    pa.Table.from_batches([batch]), bounds, config.distance_method
+                ).to_batches()
+            ),
+        )
+
+
+PROPERTY_KEYS = ["property_id", "month_end", "market_name", "host_id"]
+
+# Per-property sums of aggregate_reservations. Sums merge across any split of
+# the rows, property_metrics derives the rates from them once at the end.
+PROPERTY_SUMS = [
+    "total_revenue",
+    "num_local_reservations",
+    "booked_nights",
+    "num_ratings",
+    "stars_sum",
+]
+
+# The metrics property_analytics stores for every property
+PROPERTY_METRICS = [
+    "total_revenue",
+    "num_local_reservations",
+    "booked_nights",
+    "occupancy_rate",
+    "num_ratings",
+    "stars",
+]
+
+
+def aggregate_reservations(reservations):
+    # Per-property PROPERTY_SUMS from Arrow reservation rows, all in the same
+    # group by. Like pandas' groupby, rows with a missing key are left out.
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    reservations = reservations.filter(
+        functools.reduce(
+            pc.and_, [pc.is_valid(reservations[key]) for key in PROPERTY_KEYS]
+        )
+    )
+    is_local = pc.fill_null(
+        pc.less_equal(reservations["dist"], LOCAL_RESERVATION_MILES), False
+    )
+    return _sum_by_property(
+        pa.table(
+            {
+                **{key: reservations[key] for key in PROPERTY_KEYS},
+                "total_revenue": pc.cast(reservations["total_cost"], pa.float64()),
+                "num_local_reservations": pc.cast(is_local, pa.int64()),
+                "booked_nights": pc.cast(reservations["nights"], pa.int64()),
+                # Unrated stays are left out of the average
+                "num_ratings": pc.cast(pc.is_valid(reservations["stars"]), pa.int64()),
+                "stars_sum": pc.cast(reservations["stars"], pa.float64()),
+            }
+        )
+    )
+
+
+def merge_aggregates(partials):
+    # Folds partial outputs of aggregate_reservations into one. Revenue is
+    # integral cents summed in float64, so the result is exact regardless of
+    # how the rows were split up.
+    import pyarrow as pa
+
+    return _sum_by_property(pa.concat_tables(partials))
+
+
+def _sum_by_property(table):
+    import pyarrow.compute as pc
+
+    sum_all = pc.ScalarAggregateOptions(min_count=0)
+    with instrumentation.span("groupby", rows=table.num_rows):
+        grouped = table.group_by(PROPERTY_KEYS).aggregate(
+            [(column, "sum", sum_all) for column in PROPERTY_SUMS]
+        )
+    return grouped.rename_columns(
+        [name.removesuffix("_sum") for name in grouped.column_names]
+    )
+
+
+def property_metrics(aggregates, bounds):
+    # PROPERTY_METRICS from merged aggregate_reservations sums. Nights count
+    # towards the month a stay ends in, like its revenue, so a stay that
+    # began the month before can push the rate past 1 and is capped.
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    nights = pc.cast(aggregates["booked_nights"], pa.float64())
+    ratings = pc.cast(aggregates["num_ratings"], pa.float64())
+    metrics = {
+        "occupancy_rate": pc.min_element_wise(
+            pc.divide(nights, float(window_days(bounds))), 1.0
+        ),
+        "stars": pc.if_else(
+            pc.greater(ratings, 0),
+            pc.divide(aggregates["stars_sum"], ratings),
+            pa.scalar(None, pa.float64()),
+        ),
+    }
+    return pa.table(
+        {
+            column: metrics[column] if column in metrics else aggregates[column]
+            for column in PROPERTY_KEYS + PROPERTY_METRICS
+        }
+    )
+
+
+class PropertyAnalyticsConfig(Config):
+    # Compute distances and aggregate inside DuckDB, straight from the source
+    # tables, so only one row per property is loaded into pandas. Doesn't
+    # read the monthly_reservations snapshot, so it can run without it. DuckDB
+    # only has the haversine distance, which this mode uses by default and
+    # requires.
+    compute_in_database: bool = False
+    # When set, read the source tables in record batches of this many rows
+    # and fold each batch into running per-property aggregates, so memory is
+    # bounded by the batch size instead of the month's reservations
+    stream_batch_size: Optional[int] = None
+    # Distance method for the modes that query the reservation table, see
+    # MonthlyReservationsConfig. Unset, it is "haversine" with
+    # compute_in_database and "geodesic" otherwise.
+    distance_method: Optional[str] = None
+    # Recompute only the properties with reservations added or corrected
+    # since the partition was last materialized, and keep the stored rows of
+    # every other property
+    incremental: bool = False
+
+
+def stored_property_analytics(database, month_end):
+    # The partition as last written by the IO manager, or None if it was
+    # never materialized
+    exists = database.query(
+        """
+        SELECT count(*) AS n FROM information_schema.tables
+        WHERE table_name = 'property_analytics'
+        """
+    ).iloc[0]["n"]
+    if not exists:
+        return None
+    stored = database.query_arrow(
         f"""
-        SELECT
-            r.id,
-            r.property_id,
-            r.guest_id,
-            r.created_at,
-            r.total_cost,
-            g.lat AS lat_guest,
-            g.lon AS lon_guest,
-            p.lon,
-            p.lat,
-            p.host_id,
-            p.market_name
-        FROM
-            reservation r
-        LEFT JOIN
-            property p ON r.property_id = p.id
-        LEFT JOIN
-            guest g ON r.guest_id = g.id
-        WHERE r.end_date >= '{bounds.start}' AND r.end_date < '{bounds.end}'
-    """
+        SELECT {", ".join(PROPERTY_KEYS + PROPERTY_METRICS)}
+        FROM property_analytics
+        WHERE month_end = $month_end
+        """,
+        {"month_end": month_end},
     )
+    return stored if stored.num_rows else None
 
-    results["dist"] = results.apply(calc_dist, axis=1)
-    results["month_end"] = pd.to_datetime(bounds.end)
-    return results
 
+def update_property_analytics(stored, database, bounds, property_ids, distance_method):
+    # Replaces the rows of property_ids in stored with aggregates recomputed
+    # from their reservations
+    import pyarrow as pa
+    import pyarrow.compute as pc
 
-def calc_dist(row):
-    return geodesic(
-        (row["lat"], row["lon"]), (row["lat_guest"], row["lon_guest"])
-    ).miles
+    reservations = database.query_arrow(
+        RESERVATIONS_QUERY + " AND r.property_id IN (SELECT unnest($property_ids))",
+        {**reservations_params(bounds), "property_ids": property_ids},
+    )
+    recomputed = property_metrics(
+        aggregate_reservations(with_distance(reservations, bounds, distance_method)),
+        bounds,
+    )
+    unchanged = stored.filter(
+        pc.invert(pc.is_in(stored["property_id"], pa.array(property_ids, pa.int64())))
+    )
+    return pa.concat_tables(
+        [unchanged, recomputed.select(unchanged.column_names).cast(unchanged.schema)]
+    )
 
 
 @asset(
     partitions_def=monthly_partition_def,
-    metadata={"partition_expr": "month_end"},
+    ins={"monthly_reservations": AssetIn(dagster_type=Nothing)},
+    metadata={
+        "partition_expr": month_end_partition_expr,
+        "sort_by": month_end_sort_key,
+    },
 )
 def property_analytics(
-    monthly_reservations: pd.DataFrame,
-) -> pd.DataFrame:
-    reservations_grouped = (
-        monthly_reservations.groupby(
-            ["property_id", "month_end", "market_name", "host_id"]
-        )
-        .agg(
-            total_revenue=pd.NamedAgg(column="total_cost", aggfunc="sum"),
-            num_local_reservations=pd.NamedAgg(
-                column="dist", aggfunc=lambda x: (x <= 100).sum()
-            ),
+    context: AssetExecutionContext,
+    config: PropertyAnalyticsConfig,
+    database: Database,
+):
+    import pandas as pd
+    import pyarrow as pa
+
+    with instrumentation.instrument(context) as recorder:
+        distance_method = config.distance_method or (
+            "haversine" if config.compute_in_database else "geodesic"
         )
-        .reset_index()
-    )
+        if config.compute_in_database and distance_method != "haversine":
+            raise ValueError(
+                "compute_in_database only supports distance_method 'haversine', "
+                f"got {distance_method!r}"
+            )
+        bounds = context.partition_time_window
+        month_end = str(bounds.end)
+        # Paths that query the reservation table take its watermark before
+        # reading, so reservations arriving mid-run are picked up by the next
+        # incremental run
+        watermark = watermarks.current_watermark(database, reservations_params(bounds))
+        previous_watermark = (
+            watermarks.read_watermark(
+                context.instance, context.asset_key, context.partition_key
+            )
+            if config.incremental
+            else None
+        )
+        stored = (
+            stored_property_analytics(database, month_end)
+            if previous_watermark is not None
+            else None
+        )
+
+        if stored is not None:
+            changed = watermarks.changed_property_ids(
+                database, reservations_params(bounds), previous_watermark
+            )
+            context.log.info(f"Recomputing {len(changed)} changed properties")
+            reservations_grouped = update_property_analytics(
+                stored, database, bounds, changed, distance_method
+            ).to_pandas()
+            recorder.metadata.update({"changed_properties": len(changed)})
+        elif config.compute_in_database:
+            reservations_grouped = database.query(
+                f"""
+                SELECT
+                    property_id,
+                    host_id,
+                    market_name,
+                    SUM(total_cost) AS total_revenue,
+                    COUNT(*) FILTER (
+                        WHERE haversine_miles(lat, lon, lat_guest, lon_guest)
+                            <= {LOCAL_RESERVATION_MILES}
+                    ) AS num_local_reservations,
+                    SUM(nights)::BIGINT AS booked_nights,
+                    LEAST(SUM(nights) / $days, 1.0) AS occupancy_rate,
+                    COUNT(stars) AS num_ratings,
+                    AVG(stars) AS stars
+                FROM ({RESERVATIONS_QUERY})
+                WHERE
+                    property_id IS NOT NULL
+                    AND host_id IS NOT NULL
+                    AND market_name IS NOT NULL
+                GROUP BY property_id, host_id, market_name
+            """,
+                {**reservations_params(bounds), "days": window_days(bounds)},
+            )
+            reservations_grouped["month_end"] = pd.to_datetime(bounds.end)
+        elif config.stream_batch_size:
+            batches = database.query_batches(
+                RESERVATIONS_QUERY,
+                reservations_params(bounds),
+                batch_size=config.stream_batch_size,
+            )
+            running = None
+            num_batches = 0
+            for batch in batches:
+                partial = aggregate_reservations(
+                    with_distance(
+                        pa.Table.from_batches([batch]), bounds, distance_method
+                    )
+                )
+                running = (
+                    partial if running is None else merge_aggregates([running, partial])
+                )
+                num_batches += 1
+            context.log.info(f"Aggregated reservations from {num_batches} batches")
+            if running is None:
+                empty = pa.Table.from_batches([], schema=batches.schema)
+                running = aggregate_reservations(
+                    with_distance(empty, bounds, distance_method)
+                )
+            reservations_grouped = property_metrics(running, bounds).to_pandas()
+        else:
+            monthly_reservations = database.query_arrow(
+                """
+                SELECT
+                    property_id, month_end, market_name, host_id,
+                    total_cost, dist, nights, stars
+                FROM monthly_reservations
+                WHERE month_end = $month_end
+                """,
+                {"month_end": month_end},
+            )
+            reservations_grouped = property_metrics(
+                aggregate_reservations(monthly_reservations), bounds
+            ).to_pandas()
+            # The snapshot may predate reservations already in the table
+            watermark = watermarks.snapshot_watermark(database, month_end)
 
-    return reservations_grouped[
-        [
-            "property_id",
-            "host_id",
-            "market_name",
-            "month_end",
-            "total_revenue",
-            "num_local_reservations",
+        recorder.metadata.update(
+            {watermarks.WATERMARK_METADATA_KEY: MetadataValue.json(watermark)}
+        )
+
+        reservations_grouped = reservations_grouped.sort_values(
+            "property_id", ignore_index=True
+        )
+        return reservations_grouped[
+            ["property_id", "host_id", "market_name", "month_end", *PROPERTY_METRICS]
         ]
-    ]
 
 
-# @asset(
-#     partitions_def=monthly_partition_def,
-#     metadata={"partition_expr": "month_end"},
-# )
-# def market_analytics(
-#     property_analytics: pd.DataFrame,
-# ) -> pd.DataFrame:
-#     def create_histogram(data, bins=10):
-#         hist, bin_edges = np.histogram(data, bins=bins)
-#         return {"bins_start": bin_edges[:-1], "bins_end": bin_edges[1:], "counts": hist}
+# Row order of the market rollup tables
+market_sort_key = ["month_end", "market_name", "metric"]
+period_sort_key = ["period_end", "market_name", "metric"]
+
+# Quarters and years are combined from the monthly market rollups. They start
+# with the first one whose months are all partitions.
+quarterly_partition_def = TimeWindowPartitionsDefinition(
+    start="2023-04-01", cron_schedule="0 0 1 */3 *", fmt="%Y-%m-%d"
+)
+yearly_partition_def = TimeWindowPartitionsDefinition(
+    start="2024-01-01", cron_schedule="0 0 1 1 *", fmt="%Y-%m-%d"
+)
+period_end_partition_expr = "period_end - INTERVAL 1 DAY"
+
+
+@asset(
+    partitions_def=monthly_partition_def,
+    ins={
+        "property_analytics": AssetIn(
+            metadata={
+                "columns": ["market_name", *rollups.MARKET_METRICS],
+                # The rollup works on the Arrow columns, see rollups.py
+                "arrow": True,
+            }
+        )
+    },
+    metadata={
+        "partition_expr": month_end_partition_expr,
+        "sort_by": market_sort_key,
+    },
+)
+def market_analytics(context: AssetExecutionContext, property_analytics):
+    # Count, sum, min, max, fixed-bin histogram and percentiles of every
+    # metric in rollups.MARKET_METRICS per market, see rollups.py
+    import pandas as pd
+    import pyarrow.compute as pc
+
+    with instrumentation.instrument(context) as recorder:
+        month_end = pd.Timestamp(context.partition_time_window.end)
+        with instrumentation.span("market_rollup", rows=property_analytics.num_rows):
+            rollup = rollups.market_rollup(property_analytics, month_end)
+        recorder.metadata.update(
+            {"markets": len(pc.unique(property_analytics["market_name"]))}
+        )
+        return rollup
+
+
+def combine_market_analytics(context, market_analytics):
+    # Merges the monthly rollups of the partition's months, without reading
+    # any property rows
+    import pandas as pd
 
-#     market_df = property_analytics.groupby(["market_name", "month_end"]).agg(
-#         total_properties=pd.NamedAgg(column="property_id", aggfunc="count"),
-#         total_revenue_hist=pd.NamedAgg(
-#             column="total_revenue", aggfunc=lambda x: create_histogram(x)
-#         ),
-#     )
+    bounds = context.partition_time_window
+    num_months = market_analytics["month_end"].nunique()
+    expected_months = (bounds.end.year - bounds.start.year) * 12 + (
+        bounds.end.month - bounds.start.month
+    )
+    if num_months < expected_months:
+        context.log.warning(
+            f"Combining {num_months} of {expected_months} months, "
+            f"materialize market_analytics for the missing ones"
+        )
+    with instrumentation.span("market_rollup", rows=len(market_analytics)):
+        combined = rollups.merge_rollups(market_analytics, pd.Timestamp(bounds.end))
+    return combined, num_months
 
-#     market_df.reset_index(inplace=True)
 
-#     return market_df
+@asset(
+    partitions_def=quarterly_partition_def,
+    ins={"market_analytics": AssetIn(partition_mapping=TimeWindowPartitionMapping())},
+    metadata={
+        "partition_expr": period_end_partition_expr,
+        "sort_by": period_sort_key,
+    },
+)
+def quarterly_market_analytics(context: AssetExecutionContext, market_analytics):
+    with instrumentation.instrument(context) as recorder:
+        combined, num_months = combine_market_analytics(context, market_analytics)
+        recorder.metadata.update({"months": num_months})
+        return combined
+
+
+@asset(
+    partitions_def=yearly_partition_def,
+    ins={"market_analytics": AssetIn(partition_mapping=TimeWindowPartitionMapping())},
+    metadata={
+        "partition_expr": period_end_partition_expr,
+        "sort_by": period_sort_key,
+    },
+)
+def yearly_market_analytics(context: AssetExecutionContext, market_analytics):
+    with instrumentation.instrument(context) as recorder:
+        combined, num_months = combine_market_analytics(context, market_analytics)
+        recorder.metadata.update({"months": num_months})
+        return combined
+
+
+def iter_property_frames(property_analytics):
+    # Yields (property_id, rows sorted by month_end) for every property. A
+    # single sort makes each property's rows contiguous, so every frame is a
+    # slice rather than a boolean mask over the whole table.
+    import numpy as np
+
+    if property_analytics.empty:
+        return
+    with instrumentation.span("groupby", rows=len(property_analytics)):
+        sorted_df = property_analytics.sort_values(
+            ["property_id", "month_end"], kind="stable", ignore_index=True
+        )
+        property_ids = sorted_df["property_id"].to_numpy()
+        boundaries = np.flatnonzero(property_ids[1:] != property_ids[:-1]) + 1
+    starts = np.concatenate([[0], boundaries])
+    ends = np.concatenate([boundaries, [len(sorted_df)]])
+    for start, end in zip(starts, ends):
+        yield property_ids[start], sorted_df.iloc[start:end]
+
+
+# The column of historical_bar_charts holding each chart type's chart paths
+CHART_COLUMNS = {
+    chart_type: f"{chart_type}_chart" for chart_type in charts.chart_settings
+}
+
+
+def stored_chart_paths(database):
+    # Chart paths referenced by any stored partition of historical_bar_charts
+    # or emails_to_send, which send_emails_job reads attachments from
+    columns = database.query_arrow(
+        """
+        SELECT table_name, column_name FROM information_schema.columns
+        WHERE table_name IN ('historical_bar_charts', 'emails_to_send')
+            AND list_contains($columns, column_name)
+        """,
+        {"columns": list(CHART_COLUMNS.values())},
+    ).to_pylist()
+    if not columns:
+        return set()
+    paths = database.query_arrow(
+        " UNION ".join(
+            f"SELECT {row['column_name']} AS path FROM {row['table_name']}"
+            f" WHERE {row['column_name']} IS NOT NULL"
+            for row in columns
+        )
+    )
+    return set(paths["path"].to_pylist())
+
+
+class HistoricalBarChartsConfig(Config):
+    # Number of processes rendering charts, 1 renders in the asset's process
+    max_workers: int = 1
+    # "matplotlib", or the much faster "pillow" (PNG) or "svg" backends that
+    # draw the same layout without matplotlib, see charts.BACKENDS
+    chart_backend: str = "matplotlib"
+    # Metrics charted for every property, any of charts.chart_settings. The
+    # columns of the ones left out stay empty. Each chart type adds about as
+    # much render time as the revenue chart, so the others are opt-in.
+    chart_types: List[str] = ["total_revenue"]
 
 
 @asset(
@@ -121,93 +628,351 @@ def property_analytics(
     ins={
         "property_analytics": AssetIn(
             partition_mapping=TimeWindowPartitionMapping(start_offset=-4),
+            # Only what the charts need is read from the five months
+            metadata={"columns": ["property_id", "month_end", *charts.chart_settings]},
         )
     },
-    metadata={"partition_expr": "month_end"},
+    metadata={
+        "partition_expr": month_end_partition_expr,
+        "sort_by": month_end_sort_key,
+    },
 )
 def historical_bar_charts(
-    property_analytics: pd.DataFrame,
+    context: AssetExecutionContext,
+    config: HistoricalBarChartsConfig,
+    property_analytics,
     image_storage: LocalFileStorage,
-) -> pd.DataFrame:
-    chart_paths = []
-    for property_id in property_analytics["property_id"].unique():
-        property_data = property_analytics[
-            property_analytics["property_id"] == property_id
-        ].sort_values(by="month_end")
-        chart_buffer = charts.draw_line_chart(property_data, "total_revenue")
-        last_month_end = property_data.iloc[-1]["month_end"]
-        last_month_end_str = last_month_end.strftime("%Y/%m")
-
-        chart_path = f"{last_month_end_str}/total_revenue_property_{property_id}.png"
-        image_storage.write(
-            chart_path,
-            chart_buffer,
-        )
-        chart_paths.append(
+    chart_cache: ChartCache,
+    database: Database,
+):
+    import pandas as pd
+
+    with instrumentation.instrument(context) as recorder:
+        unknown = set(config.chart_types) - set(charts.chart_settings)
+        if unknown:
+            raise ValueError(
+                f"Unknown chart types {sorted(unknown)}, "
+                f"expected some of {list(charts.chart_settings)}"
+            )
+        extension = charts.chart_backend(config.chart_backend).extension
+
+        # property_id -> row of chart paths. Jobs refer to rows by
+        # property_id, since their keys come back from the worker processes
+        # as copies.
+        chart_rows = {}
+        num_cache_misses = 0
+
+        def stale_chart_jobs():
+            # One job per property with its charts whose data changed since
+            # they were last stored. The five months are read and grouped
+            # once for all chart types.
+            nonlocal num_cache_misses
+            for property_id, property_data in iter_property_frames(property_analytics):
+                last_month_end_str = property_data.iloc[-1]["month_end"].strftime(
+                    "%Y/%m"
+                )
+                row = chart_rows[property_id] = {"property_id": property_id}
+                keys, chart_types = [], []
+                for chart_type in config.chart_types:
+                    chart_data = charts.chart_data(property_data, chart_type)
+                    if chart_data.empty:
+                        continue
+                    chart_path = (
+                        f"{last_month_end_str}/{chart_type}_property_{property_id}"
+                        f".{extension}"
+                    )
+                    row[CHART_COLUMNS[chart_type]] = chart_path
+                    key = charts.chart_key(chart_data, chart_type, config.chart_backend)
+                    if not chart_cache.lookup(image_storage, chart_path, key):
+                        keys.append((property_id, chart_type, chart_path, key))
+                        chart_types.append(chart_type)
+                if keys:
+                    num_cache_misses += len(keys)
+                    yield keys, property_data, chart_types
+
+        num_failed = 0
+        failed_properties = set()
+        results = charts.render_line_charts(
+            stale_chart_jobs(),
+            max_workers=config.max_workers,
+            backend=config.chart_backend,
+        )
+        for (property_id, chart_type, chart_path, key), image, error in results:
+            if error is not None:
+                context.log.warning(
+                    f"Failed to render {chart_type} chart for property {property_id}: {error}"
+                )
+                del chart_rows[property_id][CHART_COLUMNS[chart_type]]
+                num_failed += 1
+                failed_properties.add(int(property_id))
+                continue
+
+            image_storage.write(chart_path, io.BytesIO(image))
+            chart_cache.record(image_storage, chart_path, key)
+
+        # Charts are durable before the materialization is reported
+        image_storage.flush()
+
+        chart_paths = [
+            path
+            for row in chart_rows.values()
+            for column, path in row.items()
+            if column != "property_id"
+        ]
+        num_evicted = chart_cache.evict(
+            image_storage, keep=stored_chart_paths(database).union(chart_paths)
+        )
+
+        recorder.metadata.update(
             {
-                "property_id": property_id,
-                "total_revenue_chart": chart_path,
+                "num_charts": len(chart_paths),
+                "num_failed": num_failed,
+                "failed_properties": sorted(failed_properties),
+                "cache_hits": len(chart_paths) + num_failed - num_cache_misses,
+                "cache_misses": num_cache_misses,
+                "cache_evictions": num_evicted,
             }
         )
 
-    line_charts = pd.DataFrame(chart_paths)
-    line_charts["month_end"] = property_analytics["month_end"].max()
+        # Typed, so a column without any chart is still stored as VARCHAR
+        line_charts = pd.DataFrame(
+            list(chart_rows.values()), columns=["property_id", *CHART_COLUMNS.values()]
+        ).astype({column: "string" for column in CHART_COLUMNS.values()})
+        line_charts["month_end"] = property_analytics["month_end"].max()
 
-    return line_charts
+        return line_charts
 
 
 @asset(
     partitions_def=monthly_partition_def,
-    metadata={"partition_expr": "month_end"},
+    metadata={
+        "partition_expr": month_end_partition_expr,
+        "sort_by": month_end_sort_key,
+    },
 )
 def emails_to_send(
-    property_analytics: pd.DataFrame,
-    historical_bar_charts: pd.DataFrame,
+    context: AssetExecutionContext,
+    property_analytics,
+    historical_bar_charts,
     database: Database,
-) -> pd.DataFrame:
-    hosts = database.query("SELECT * FROM host")
-    df_merged = property_analytics.merge(
-        hosts,
-        left_on="host_id",
-        right_on="id",
-        how="left",
-        suffixes=("", "_host"),
-    ).merge(
-        historical_bar_charts,
-        left_on=["property_id", "month_end"],
-        right_on=["property_id", "month_end"],
-        how="left",
-    )
+    host_cache: HostCache,
+):
+    import pandas as pd
 
-    return df_merged
+    with instrumentation.instrument(context):
+        # Only the month's hosts are looked up, the host table isn't read
+        hosts = host_cache.lookup(
+            database, property_analytics["host_id"].to_numpy()
+        ).to_pandas()
+        df_merged = pd.concat(
+            [property_analytics.reset_index(drop=True), hosts], axis=1
+        ).merge(
+            historical_bar_charts,
+            left_on=["property_id", "month_end"],
+            right_on=["property_id", "month_end"],
+            how="left",
+        )
 
+        return df_merged
 
-@op
-def send_emails(
-    context: AssetExecutionContext,
-    emails: pd.DataFrame,
-    email_service: EmailService,
-    image_storage: LocalFileStorage,
-) -> None:
+
+class SendEmailsConfig(Config):
+    # The month's recipients are split into this many shards, each sent by
+    # its own step, so the send runs on as many workers as the executor has
+    # and a failed shard can be re-executed on its own
+    num_shards: int = 8
+    # "host_id" spreads hosts evenly over the shards, "market_name" keeps
+    # each market's hosts in one shard
+    shard_by: str = "host_id"
+
+
+EMAIL_SHARD_KEYS = ("host_id", "market_name")
+
+
+def shard_emails_by(emails, num_shards, shard_by):
+    # {shard: rows} for every non-empty shard. pandas' hashing is stable
+    # across processes and runs, so a host always lands in the same shard.
+    import pandas as pd
+
+    if shard_by not in EMAIL_SHARD_KEYS:
+        raise ValueError(
+            f"Unknown shard key {shard_by!r}, expected one of {list(EMAIL_SHARD_KEYS)}"
+        )
+    shards = pd.util.hash_pandas_object(emails[shard_by], index=False) % num_shards
+    return {
+        int(shard): rows.reset_index(drop=True)
+        for shard, rows in emails.groupby(shards.to_numpy(), sort=True)
+    }
+
+
+EMAIL_COLUMNS = [
+    "host_id",
+    "market_name",
+    "email",
+    "name",
+    "total_revenue",
+    *CHART_COLUMNS.values(),
+    "month_end",
+]
+
+
+@op(
+    ins={"emails": In(metadata={"columns": EMAIL_COLUMNS})},
+    out=DynamicOut(io_manager_key="fs_io_manager"),
+)
+def shard_emails(context: OpExecutionContext, config: SendEmailsConfig, emails):
+    # The shards are handed to the send steps through the filesystem rather
+    # than DuckDB, which only allows one process to have the database open.
+    # Not instrumented: metadata of a dynamic output belongs to its shards.
     bounds = context.partition_time_window
-    filtered_df = emails[
+    emails = emails[
         (emails["month_end"] > bounds.start) & (emails["month_end"] <= bounds.end)
     ]
-    for _, row in filtered_df.iterrows():
-        encoded_string = base64.b64encode(
-            image_storage.read(row["total_revenue_chart"])
-        ).decode()
-        email_service.send(
-            row["email"],
-            template={"name": row["name"], "revenue": row["total_revenue"]},
-            attachments=[
-                {
-                    "Name": row["total_revenue_chart"],
-                    "Content": encoded_string,
-                    "ContentType": "image/png",
-                    "ContentID": f"cid:{row['total_revenue_chart']}",
-                }
+    shards = shard_emails_by(
+        emails.drop(columns="month_end"), config.num_shards, config.shard_by
+    )
+    context.log.info(f"Split {len(emails)} recipients into {len(shards)} shards")
+    for shard, rows in shards.items():
+        yield DynamicOutput(
+            rows, mapping_key=f"shard_{shard}", metadata={"recipients": len(rows)}
+        )
+
+
+@op(out=Out(io_manager_key="fs_io_manager"))
+def send_email_shard(
+    context: OpExecutionContext,
+    emails,
+    email_service: EmailService,
+    image_storage: LocalFileStorage,
+    delivery_ledger: DeliveryLedger,
+) -> dict:
+    with instrumentation.instrument(context):
+        # Every chart the host has, in CHART_COLUMNS order
+        emails = emails.assign(
+            attachment_names=[
+                [name for name in names if isinstance(name, str)]
+                for names in zip(*(emails[column] for column in CHART_COLUMNS.values()))
+            ]
+        )
+        missing_charts = emails["attachment_names"].map(len) == 0
+        if missing_charts.any():
+            context.log.warning(
+                f"Skipping {missing_charts.sum()} hosts without any chart"
+            )
+            emails = emails[~missing_charts]
+
+        templates = [
+            {"name": row.name, "revenue": float(row.total_revenue)}
+            for row in emails.itertuples(index=False)
+        ]
+        emails = emails.assign(
+            template=templates,
+            content_hash=[
+                ledger.content_hash(email, template, names)
+                for email, template, names in zip(
+                    emails["email"], templates, emails["attachment_names"]
+                )
             ],
+        ).drop_duplicates("content_hash")
+
+        # Hosts that already got this exact report, e.g. in an earlier attempt
+        # of this shard, are left out before any chart is read
+        partition_key = context.partition_key
+        delivered = delivery_ledger.delivered(
+            partition_key, list(zip(emails["host_id"], emails["content_hash"]))
+        )
+        if delivered:
+            keys = zip(emails["host_id"], emails["content_hash"])
+            emails = emails[[key not in delivered for key in keys]]
+            context.log.info(f"Skipping {len(delivered)} already delivered emails")
+
+        # Chart files are read and encoded ahead of the send loop, in the
+        # order the messages take them
+        encoded_charts = encode_attachments(
+            image_storage, itertools.chain.from_iterable(emails["attachment_names"])
+        )
+        emails_to_deliver = (
+            (
+                row.email,
+                row.template,
+                [
+                    {
+                        "Name": name,
+                        "Content": next(encoded_charts),
+                        "ContentType": charts.content_type(name),
+                        "ContentID": f"cid:{name}",
+                    }
+                    for name in row.attachment_names
+                ],
+            )
+            for row in emails.itertuples(index=False)
+        )
+
+        # Each request's accepted messages are recorded as one ledger write
+        host_ids = dict(zip(emails["content_hash"], emails["host_id"]))
+
+        def record_sent(messages):
+            deliveries = []
+            for message in messages:
+                content_hash = ledger.message_content_hash(message)
+                deliveries.append(
+                    (int(host_ids[content_hash]), content_hash, message["To"])
+                )
+            delivery_ledger.record(partition_key, deliveries)
+
+        result = email_service.send_many(emails_to_deliver, on_sent=record_sent)
+        context.log.info(
+            f"Sent {result.sent} emails ({result.failed} failed) in {result.requests} "
+            f"requests and {result.seconds:.2f}s, "
+            f"{result.messages_per_second:,.1f} emails/sec"
+        )
+        if result.failed:
+            # Fails only this shard's step. Re-executing it sends only the
+            # emails the ledger has no record of.
+            raise Failure(
+                description=f"Failed to send {result.failed} report emails",
+                metadata={"errors": result.errors[:20]},
+            )
+        return {
+            "shard": int(context.get_mapping_key().removeprefix("shard_")),
+            "sent": result.sent,
+            "already_sent": len(delivered),
+            "skipped": int(missing_charts.sum()),
+            "requests": result.requests,
+            "seconds": result.seconds,
+        }
+
+
+@op
+def summarize_deliveries(
+    context: OpExecutionContext, deliveries: list, delivery_ledger: DeliveryLedger
+) -> None:
+    with instrumentation.instrument(context) as recorder:
+        deliveries = sorted(deliveries, key=lambda delivery: delivery["shard"])
+        sent = sum(delivery["sent"] for delivery in deliveries)
+        already_sent = sum(delivery["already_sent"] for delivery in deliveries)
+        skipped = sum(delivery["skipped"] for delivery in deliveries)
+        context.log.info(
+            f"Sent {sent} emails from {len(deliveries)} shards, "
+            f"{already_sent} had already been delivered, "
+            f"skipped {skipped} hosts without a chart"
+        )
+        recorder.metadata.update(
+            {
+                "shards": len(deliveries),
+                "sent": sent,
+                "already_sent": already_sent,
+                "skipped": skipped,
+                # Everything delivered for the month, over all runs
+                "delivered": delivery_ledger.delivery_count(context.partition_key),
+                "requests": sum(delivery["requests"] for delivery in deliveries),
+                # The slowest shard bounds the send's wall time
+                "slowest_shard_seconds": round(
+                    max((delivery["seconds"] for delivery in deliveries), default=0.0),
+                    3,
+                ),
+                "deliveries": deliveries,
+            }
         )
 
 
@@ -215,4 +980,5 @@ def send_emails(
     partitions_def=monthly_partition_def,
 )
 def send_emails_job():
-    send_emails(emails_to_send.to_source_asset())
+    shards = shard_emails(emails_to_send.to_source_asset())
+    summarize_deliveries(shards.map(send_email_shard).collect())
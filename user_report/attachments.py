@@ -0,0 +1,48 @@
+import binascii
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def encode_base64(view):
+    # Encodes straight from the storage's memory map, the file is never
+    # copied into a bytes object first
+    with view:
+        return binascii.b2a_base64(view, newline=False).decode("ascii")
+
+
+def encode_attachments(storage, filenames, max_workers=4, prefetch=32):
+    # Yields the base64 content of each file in filenames, in order. Files are
+    # read and encoded by a thread pool up to `prefetch` files ahead of the
+    # consumer. A file listed several times is encoded once and kept only
+    # until its last use, so memory is bounded by the prefetch window rather
+    # than the number of files.
+    filenames = list(filenames)
+    remaining_uses = Counter(filenames)
+    encoded = {}
+
+    def encode(filename):
+        return encode_base64(storage.view(filename))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        queued = deque()
+        scheduled = set()
+        next_index = 0
+
+        for filename in filenames:
+            while next_index < len(filenames) and len(queued) < prefetch:
+                upcoming = filenames[next_index]
+                next_index += 1
+                if upcoming not in scheduled:
+                    scheduled.add(upcoming)
+                    queued.append((upcoming, pool.submit(encode, upcoming)))
+
+            while filename not in encoded:
+                done_filename, future = queued.popleft()
+                encoded[done_filename] = future.result()
+
+            yield encoded[filename]
+
+            remaining_uses[filename] -= 1
+            if not remaining_uses[filename]:
+                del encoded[filename]
+                scheduled.discard(filename)
@@ -0,0 +1,391 @@
+import importlib.util
+import io
+import math
+import os
+from xml.sax.saxutils import escape
+
+import numpy as np
+import pandas as pd
+from PIL import Image, ImageDraw, ImageFont
+
+from .charts import chart_settings, color
+
+# Draws the charts of charts_matplotlib.LineChartRenderer without matplotlib.
+# ChartLayout reproduces the geometry matplotlib derives from its defaults
+# (figure margins, autoscaling, tick placement, font sizes), and the
+# renderers below only draw lines, circles, boxes and text at those positions.
+
+DPI = 100
+# Pixels per typographic point
+PT = DPI / 72
+FONT_SIZE = 10 * PT
+TITLE_SIZE = 12 * PT
+TICK_LENGTH = 3.5 * PT
+TICK_PAD = 3.5 * PT
+TITLE_PAD = 6 * PT
+LINE_WIDTH = 1.5 * PT
+SPINE_WIDTH = 0.8 * PT
+MARKER_RADIUS = 3 * PT
+MARKER_EDGE_WIDTH = 0.75 * PT
+# Padding of the point label boxes, boxstyle="round,pad=0.5"
+LABEL_PAD = 0.5 * FONT_SIZE
+
+# Rendered texts kept per renderer
+MAX_CACHED_TEXTS = 4096
+
+# Days either side of a single point, like matplotlib's MonthLocator
+SINGLE_POINT_DAYS = 60
+
+
+def _nonsingular(low, high):
+    if high - low > 1e-12 * max(abs(low), abs(high), 1e-300):
+        return low, high
+    if low == 0 and high == 0:
+        return -0.05, 0.05
+    return low - 0.05 * abs(low), high + 0.05 * abs(high)
+
+
+def _nice_ticks(low, high, nbins=9):
+    # matplotlib's MaxNLocator with its default steps
+    raw_step = (high - low) / nbins
+    scale = 10 ** math.floor(math.log10(raw_step))
+    step = next(s * scale for s in (1, 2, 2.5, 5, 10) if s * scale >= raw_step)
+    first = math.ceil(low / step - 1e-9)
+    last = math.floor(high / step + 1e-9)
+    return [i * step for i in range(first, last + 1)]
+
+
+class ChartLayout:
+    # Pixel positions of every element of one chart
+
+    def __init__(self, property_data, chart_type, figsize=(8, 6)):
+        settings = chart_settings[chart_type]
+        self.width, self.height = figsize[0] * DPI, figsize[1] * DPI
+        # subplots_adjust(left=0.15) and matplotlib's default margins
+        self.left, self.right = 0.15 * self.width, 0.9 * self.width
+        self.top, self.bottom = 0.12 * self.height, 0.89 * self.height
+        self.title = settings["title"]
+
+        month_end = pd.to_datetime(property_data["month_end"])
+        if month_end.dt.tz is not None:
+            month_end = month_end.dt.tz_convert(None)
+        days = month_end.to_numpy().astype("datetime64[s]").astype(float) / 86400
+        values = property_data[chart_type].to_numpy(dtype=float)
+
+        # Autoscaling adds 5% margins around the data
+        x_low, x_high = days.min(), days.max()
+        if x_high == x_low:
+            x_low, x_high = x_low - SINGLE_POINT_DAYS, x_high + SINGLE_POINT_DAYS
+        margin = 0.05 * (x_high - x_low)
+        self.x_low, self.x_high = x_low - margin, x_high + margin
+
+        y_low, y_high = values.min(), values.max()
+        margin = 0.05 * (y_high - y_low)
+        y_low, y_high = _nonsingular(y_low - margin, y_high + margin)
+        # The same label offset and extra headroom as the matplotlib renderer
+        span = y_high - y_low
+        self.y_low = y_low - 0.2 * span
+        self.y_high = min(y_high + 0.2 * span, settings["ylim_max"])
+
+        self.points = [(self.x(d), self.y(v)) for d, v in zip(days, values)]
+        self.labels = [
+            (self.x(d), self.y(v + 0.05 * span), settings["label_format"](v))
+            for d, v in zip(days, values)
+        ]
+        self.y_ticks = [
+            (self.y(tick), settings["y_format"](tick))
+            for tick in _nice_ticks(self.y_low, self.y_high)
+        ]
+        first_month = np.datetime64(int(math.floor(self.x_low)), "D").astype(
+            "datetime64[M]"
+        )
+        months = np.arange(first_month, first_month + 24)
+        month_days = months.astype("datetime64[D]").astype(float)
+        self.x_ticks = [
+            (self.x(day), pd.Timestamp(month).strftime("%B, %Y"))
+            for month, day in zip(months, month_days)
+            if self.x_low <= day <= self.x_high
+        ]
+
+    def x(self, day):
+        fraction = (day - self.x_low) / (self.x_high - self.x_low)
+        return self.left + fraction * (self.right - self.left)
+
+    def y(self, value):
+        fraction = (value - self.y_low) / (self.y_high - self.y_low)
+        return self.bottom - fraction * (self.bottom - self.top)
+
+
+def _font_path(name):
+    # matplotlib ships DejaVu Sans, the font its charts use. Locate it
+    # without importing matplotlib.
+    spec = importlib.util.find_spec("matplotlib")
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    path = os.path.join(
+        spec.submodule_search_locations[0], "mpl-data", "fonts", "ttf", name
+    )
+    return path if os.path.exists(path) else None
+
+
+def _load_font(name, size):
+    path = _font_path(name)
+    if path is None:
+        return ImageFont.load_default(size)
+    return ImageFont.truetype(path, size)
+
+
+class PillowLineChartRenderer:
+    # Draws the shapes of the layout with Pillow at `supersample` times the
+    # size and scales them down, which smooths their edges like matplotlib's
+    # antialiasing. Text is antialiased by FreeType already and is drawn
+    # afterwards at the final size.
+
+    def __init__(self, chart_type, figsize=(8, 6), supersample=2):
+        self.chart_type = chart_type
+        self.figsize = figsize
+        self.scale = supersample
+        self.color = tuple(round(c * 255) for c in color)
+        self.font = _load_font("DejaVuSans.ttf", round(FONT_SIZE))
+        self.bold_font = _load_font("DejaVuSans-Bold.ttf", round(FONT_SIZE))
+        self.title_font = _load_font("DejaVuSans.ttf", round(TITLE_SIZE))
+        self.palette = self._palette()
+        # Tick labels and titles repeat across charts, so rendered text is
+        # kept as masks to paste
+        self._text_masks = {}
+
+    def _text(self, image, xy, text, fill, font, anchor):
+        key = (id(font), text, anchor)
+        if key not in self._text_masks:
+            left, top, right, bottom = font.getbbox(text, anchor=anchor)
+            mask = Image.new("L", (right - left, bottom - top))
+            ImageDraw.Draw(mask).text(
+                (-left, -top), text, fill=255, font=font, anchor=anchor
+            )
+            if len(self._text_masks) >= MAX_CACHED_TEXTS:
+                self._text_masks.clear()
+            self._text_masks[key] = mask, left, top
+        mask, left, top = self._text_masks[key]
+        image.paste(fill, (round(xy[0]) + left, round(xy[1]) + top), mask)
+
+    def _palette(self):
+        # Every antialiased pixel lies between white and either black or the
+        # chart color. Mapping onto those two ramps keeps the PNG small and
+        # fast to encode, within a few levels of the RGB image.
+        colors = [(255, 255, 255)]
+        steps = 39
+        for i in range(1, steps + 1):
+            colors.append((round(255 * (1 - i / steps)),) * 3)
+        # The lightest tints are left out, so white never maps onto them
+        for i in range(4, steps + 1):
+            alpha = i / steps
+            colors.append(
+                tuple(round(255 * (1 - alpha) + c * alpha) for c in self.color)
+            )
+        palette = Image.new("P", (1, 1))
+        palette.putpalette([channel for rgb in colors for channel in rgb])
+        return palette
+
+    def _px(self, value):
+        return value * self.scale
+
+    def _width(self, value):
+        return max(1, round(value * self.scale))
+
+    def _draw_shapes(self, layout, label_boxes):
+        px = self._px
+        image = Image.new(
+            "RGB", (round(px(layout.width)), round(px(layout.height))), "white"
+        )
+        draw = ImageDraw.Draw(image)
+
+        # Spines and ticks
+        spine = self._width(SPINE_WIDTH)
+        draw.line(
+            [
+                (px(layout.left), px(layout.top)),
+                (px(layout.left), px(layout.bottom)),
+                (px(layout.right), px(layout.bottom)),
+            ],
+            fill="black",
+            width=spine,
+        )
+        for y, _ in layout.y_ticks:
+            draw.line(
+                [(px(layout.left - TICK_LENGTH), px(y)), (px(layout.left), px(y))],
+                fill="black",
+                width=spine,
+            )
+        for x, _ in layout.x_ticks:
+            draw.line(
+                [(px(x), px(layout.bottom)), (px(x), px(layout.bottom + TICK_LENGTH))],
+                fill="black",
+                width=spine,
+            )
+
+        # The line with its markers
+        points = [(px(x), px(y)) for x, y in layout.points]
+        if len(points) > 1:
+            draw.line(
+                points, fill=self.color, width=self._width(LINE_WIDTH), joint="curve"
+            )
+        radius = px(MARKER_RADIUS)
+        for x, y in points:
+            draw.ellipse(
+                [x - radius, y - radius, x + radius, y + radius],
+                fill=self.color,
+                outline="white",
+                width=self._width(MARKER_EDGE_WIDTH),
+            )
+
+        # Point label boxes
+        for box in label_boxes:
+            draw.rounded_rectangle(
+                [px(value) for value in box], radius=px(LABEL_PAD), fill=self.color
+            )
+
+        if self.scale > 1:
+            image = image.reduce(self.scale)
+        return image
+
+    def render(self, property_data):
+        layout = ChartLayout(property_data, self.chart_type, self.figsize)
+        label_boxes = []
+        for x, y, text in layout.labels:
+            left, top, right, bottom = self.bold_font.getbbox(text, anchor="ms")
+            label_boxes.append(
+                (
+                    x + left - LABEL_PAD,
+                    y + top - LABEL_PAD,
+                    x + right + LABEL_PAD,
+                    y + bottom + LABEL_PAD,
+                )
+            )
+        image = self._draw_shapes(layout, label_boxes)
+
+        black, white = (0, 0, 0), (255, 255, 255)
+        for y, text in layout.y_ticks:
+            self._text(
+                image,
+                (layout.left - TICK_LENGTH - TICK_PAD, y),
+                text,
+                black,
+                self.font,
+                "rm",
+            )
+        for x, text in layout.x_ticks:
+            self._text(
+                image,
+                (x, layout.bottom + TICK_LENGTH + TICK_PAD),
+                text,
+                black,
+                self.font,
+                "ma",
+            )
+        self._text(
+            image,
+            ((layout.left + layout.right) / 2, layout.top - TITLE_PAD),
+            layout.title,
+            black,
+            self.title_font,
+            "ms",
+        )
+        for x, y, text in layout.labels:
+            self._text(image, (x, y), text, white, self.bold_font, "ms")
+
+        image = image.quantize(palette=self.palette, dither=Image.Dither.NONE)
+        buffer = io.BytesIO()
+        image.save(buffer, format="png", compress_level=1)
+        buffer.seek(0)
+        return buffer
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SvgLineChartRenderer:
+    # Writes the layout as SVG text. Viewers draw the text themselves, so
+    # label boxes are sized from an estimated average character width.
+
+    # Average advance of DejaVu Sans Bold digits and separators, in em
+    CHAR_WIDTH = 0.65
+
+    def __init__(self, chart_type, figsize=(8, 6)):
+        self.chart_type = chart_type
+        self.figsize = figsize
+        self.color = "#{:02x}{:02x}{:02x}".format(*(round(c * 255) for c in color))
+
+    def render(self, property_data):
+        layout = ChartLayout(property_data, self.chart_type, self.figsize)
+        parts = [
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{layout.width:g}" '
+            f'height="{layout.height:g}" viewBox="0 0 {layout.width:g} '
+            f'{layout.height:g}" font-family="DejaVu Sans, Verdana, sans-serif" '
+            f'font-size="{FONT_SIZE:.2f}">',
+            f'<rect width="100%" height="100%" fill="white"/>',
+            f'<path d="M{layout.left:.2f},{layout.top:.2f}V{layout.bottom:.2f}'
+            f'H{layout.right:.2f}" fill="none" stroke="black" '
+            f'stroke-width="{SPINE_WIDTH:.2f}"/>',
+        ]
+        for y, text in layout.y_ticks:
+            parts.append(
+                f'<path d="M{layout.left - TICK_LENGTH:.2f},{y:.2f}H{layout.left:.2f}"'
+                f' stroke="black" stroke-width="{SPINE_WIDTH:.2f}"/>'
+                f'<text x="{layout.left - TICK_LENGTH - TICK_PAD:.2f}" y="{y:.2f}" '
+                f'text-anchor="end" dominant-baseline="central">{escape(text)}</text>'
+            )
+        for x, text in layout.x_ticks:
+            parts.append(
+                f'<path d="M{x:.2f},{layout.bottom:.2f}v{TICK_LENGTH:.2f}" '
+                f'stroke="black" stroke-width="{SPINE_WIDTH:.2f}"/>'
+                f'<text x="{x:.2f}" y="{layout.bottom + TICK_LENGTH + TICK_PAD:.2f}" '
+                f'text-anchor="middle" dominant-baseline="hanging">'
+                f"{escape(text)}</text>"
+            )
+        parts.append(
+            f'<text x="{(layout.left + layout.right) / 2:.2f}" '
+            f'y="{layout.top - TITLE_PAD:.2f}" text-anchor="middle" '
+            f'font-size="{TITLE_SIZE:.2f}">{escape(layout.title)}</text>'
+        )
+
+        points = " ".join(f"{x:.2f},{y:.2f}" for x, y in layout.points)
+        parts.append(
+            f'<polyline points="{points}" fill="none" stroke="{self.color}" '
+            f'stroke-width="{LINE_WIDTH:.2f}" stroke-linejoin="round"/>'
+        )
+        for x, y in layout.points:
+            parts.append(
+                f'<circle cx="{x:.2f}" cy="{y:.2f}" r="{MARKER_RADIUS:.2f}" '
+                f'fill="{self.color}" stroke="white" '
+                f'stroke-width="{MARKER_EDGE_WIDTH:.2f}"/>'
+            )
+
+        for x, y, text in layout.labels:
+            width = len(text) * self.CHAR_WIDTH * FONT_SIZE + 2 * LABEL_PAD
+            height = 0.73 * FONT_SIZE + 2 * LABEL_PAD
+            parts.append(
+                f'<rect x="{x - width / 2:.2f}" y="{y - 0.73 * FONT_SIZE - LABEL_PAD:.2f}"'
+                f' width="{width:.2f}" height="{height:.2f}" rx="{LABEL_PAD:.2f}" '
+                f'fill="{self.color}"/>'
+                f'<text x="{x:.2f}" y="{y:.2f}" text-anchor="middle" fill="white" '
+                f'font-weight="bold">{escape(text)}</text>'
+            )
+        parts.append("</svg>")
+
+        buffer = io.BytesIO("".join(parts).encode())
+        return buffer
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,116 @@
+import io
+
+import matplotlib.dates as mdates
+import matplotlib.ticker as ticker
+import pandas as pd
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from .charts import chart_settings, color
+
+
+class LineChartRenderer:
+    # Builds the figure, axes, formatters and styling for a chart type once,
+    # then only swaps the line data and point labels for each property. The
+    # figure is not registered with pyplot, so nothing accumulates between
+    # charts and close() releases it immediately.
+
+    def __init__(self, chart_type, figsize=(8, 6)):
+        self.chart_type = chart_type
+        self.settings = chart_settings[chart_type]
+
+        self.figure = Figure(figsize=figsize)
+        FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot()
+        # Same marker styling seaborn's lineplot applies
+        (self.line,) = self.ax.plot(
+            [],
+            [],
+            marker="o",
+            color=color,
+            markeredgecolor="w",
+            markeredgewidth=0.75,
+        )
+        self.labels = []
+
+        # Format y-axis labels
+        self.ax.yaxis.set_major_formatter(
+            ticker.FuncFormatter(lambda x, pos: self.settings["y_format"](x))
+        )
+
+        # Set the title and clear the axis labels
+        self.ax.set_title(self.settings["title"])
+        self.ax.set_xlabel("")
+        self.ax.set_ylabel("")
+
+        # Format x-axis labels as month, year
+        self.ax.xaxis.set_major_locator(mdates.MonthLocator())
+        self.ax.xaxis.set_major_formatter(mdates.DateFormatter("%B, %Y"))
+
+        # Remove gridlines and the top/right spines
+        self.ax.grid(False)
+        self.ax.spines[["top", "right"]].set_visible(False)
+
+        # Increase left margin for more spacing
+        self.figure.subplots_adjust(left=0.15)
+
+    def _label(self, i):
+        while len(self.labels) <= i:
+            self.labels.append(
+                self.ax.text(
+                    0,
+                    0,
+                    "",
+                    color="white",
+                    weight="bold",
+                    ha="center",
+                    bbox=dict(
+                        facecolor=color, edgecolor=color, boxstyle="round,pad=0.5"
+                    ),
+                )
+            )
+        return self.labels[i]
+
+    def render(self, property_data):
+        month_end = pd.to_datetime(property_data["month_end"])
+        if month_end.dt.tz is not None:
+            month_end = month_end.dt.tz_convert(None)
+        x_values = mdates.date2num(month_end.to_numpy())
+        y_values = property_data[self.chart_type].to_numpy(dtype=float)
+
+        self.line.set_data(x_values, y_values)
+        # The previous chart's set_ylim switched autoscaling off
+        self.ax.set_autoscale_on(True)
+        self.ax.relim()
+        self.ax.autoscale_view()
+        y_min, y_max = self.ax.get_ylim()
+
+        # Add labels to the points
+        for i, (x_value, y_value) in enumerate(zip(x_values, y_values)):
+            label = self._label(i)
+            label.set_position((x_value, y_value + 0.05 * (y_max - y_min)))
+            label.set_text(self.settings["label_format"](y_value))
+            label.set_visible(True)
+        for label in self.labels[len(y_values) :]:
+            label.set_visible(False)
+
+        # Increase y-axis limits to add space
+        y_min_new = y_min - 0.2 * (y_max - y_min)
+        y_max_new = y_max + 0.2 * (y_max - y_min)
+        self.ax.set_ylim(y_min_new, min(y_max_new, self.settings["ylim_max"]))
+
+        # Save the plot
+        buffer = io.BytesIO()
+        self.figure.savefig(buffer, format="png")
+        buffer.seek(0)
+        return buffer
+
+    def close(self):
+        self.figure.clear()
+        self.labels = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
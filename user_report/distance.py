@@ -0,0 +1,152 @@
+import numpy as np
+
+# WGS-84 ellipsoid in kilometers, the same model geopy's geodesic() defaults to
+WGS84_A = 6378.137
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+
+# Mean earth radius used by geopy's great_circle()
+EARTH_RADIUS_KM = 6371.009
+KM_PER_MILE = 1.609344
+
+# Geodesic results agree with geopy.distance.geodesic to within this many miles
+# (about 2mm). Haversine treats the earth as a sphere and can be off by up to
+# ~0.5% of the distance, which is plenty for the 100 mile "local" cutoff.
+GEODESIC_TOLERANCE_MILES = 1e-6
+
+
+def _radians(*values):
+    return [np.radians(np.asarray(value, dtype=np.float64)) for value in values]
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = _radians(lat1, lon1, lat2, lon2)
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1))) / KM_PER_MILE
+
+
+def geodesic(lat1, lon1, lat2, lon2, max_iter=200, tol=1e-12):
+    # Vincenty's inverse formula, evaluated for every pair at once
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*_radians(lat1, lon1, lat2, lon2))
+
+    L = np.mod(lon2 - lon1 + np.pi, 2 * np.pi) - np.pi
+    U1 = np.arctan((1 - WGS84_F) * np.tan(lat1))
+    U2 = np.arctan((1 - WGS84_F) * np.tan(lat2))
+    sin_u1, cos_u1 = np.sin(U1), np.cos(U1)
+    sin_u2, cos_u2 = np.sin(U2), np.cos(U2)
+
+    lam = L
+    converged = np.isnan(L)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for _ in range(max_iter):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(
+                cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam
+            )
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(
+                sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma
+            )
+            cos2_alpha = 1 - sin_alpha**2
+            # Equatorial lines have cos2_alpha == 0
+            cos_2sigma_m = np.where(
+                cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha
+            )
+            C = WGS84_F / 16 * cos2_alpha * (4 + WGS84_F * (4 - 3 * cos2_alpha))
+            lam_prev = lam
+            lam = L + (1 - C) * WGS84_F * sin_alpha * (
+                sigma
+                + C
+                * sin_sigma
+                * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m**2))
+            )
+            converged = converged | (np.abs(lam - lam_prev) < tol)
+            if converged.all():
+                break
+
+        u2 = cos2_alpha * (WGS84_A**2 - WGS84_B**2) / WGS84_B**2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = (
+            B
+            * sin_sigma
+            * (
+                cos_2sigma_m
+                + B
+                / 4
+                * (
+                    cos_sigma * (-1 + 2 * cos_2sigma_m**2)
+                    - B
+                    / 6
+                    * cos_2sigma_m
+                    * (-3 + 4 * sin_sigma**2)
+                    * (-3 + 4 * cos_2sigma_m**2)
+                )
+            )
+        )
+        km = WGS84_B * A * (sigma - delta_sigma)
+
+    # Vincenty does not converge for nearly antipodal points, so solve the
+    # (rare) leftovers with Karney's algorithm the same way geopy does.
+    if not converged.all():
+        from geographiclib.geodesic import Geodesic
+
+        for i in np.flatnonzero(~converged):
+            km.flat[i] = (
+                Geodesic.WGS84.Inverse(
+                    np.degrees(lat1.flat[i]),
+                    np.degrees(lon1.flat[i]),
+                    np.degrees(lat2.flat[i]),
+                    np.degrees(lon2.flat[i]),
+                )["s12"]
+                / 1000
+            )
+
+    return km / KM_PER_MILE
+
+
+METHODS = {
+    "haversine": haversine,
+    "geodesic": geodesic,
+}
+
+
+def distance_miles(lat1, lon1, lat2, lon2, method="geodesic"):
+    if method not in METHODS:
+        raise ValueError(
+            f"Unknown distance method {method!r}, expected one of {sorted(METHODS)}"
+        )
+    return METHODS[method](lat1, lon1, lat2, lon2)
+
+
+def destination(lat, lon, bearing, miles):
+    # The point `miles` away from (lat, lon) along the initial bearing in
+    # degrees, on the same sphere as haversine(). Matches geopy's
+    # great_circle().destination() for arrays of points.
+    lat, lon, bearing = _radians(lat, lon, bearing)
+    delta = np.asarray(miles, dtype=np.float64) * KM_PER_MILE / EARTH_RADIUS_KM
+    lat2 = np.arcsin(
+        np.sin(lat) * np.cos(delta) + np.cos(lat) * np.sin(delta) * np.cos(bearing)
+    )
+    lon2 = lon + np.arctan2(
+        np.sin(bearing) * np.sin(delta) * np.cos(lat),
+        np.cos(delta) - np.sin(lat) * np.sin(lat2),
+    )
+    lon2 = np.mod(lon2 + np.pi, 2 * np.pi) - np.pi
+    return np.degrees(lat2), np.degrees(lon2)
+
+
+# The haversine formula as a DuckDB macro, so distances can be computed inside
+# queries without shipping coordinates to Python
+HAVERSINE_SQL_MACRO = f"""
+CREATE OR REPLACE TEMP MACRO haversine_miles(lat1, lon1, lat2, lon2) AS
+    2 * {EARTH_RADIUS_KM / KM_PER_MILE!r} * asin(sqrt(least(1,
+        pow(sin(radians(lat2 - lat1) / 2), 2)
+        + cos(radians(lat1)) * cos(radians(lat2))
+        * pow(sin(radians(lon2 - lon1) / 2), 2)
+    )))
+"""
@@ -0,0 +1,129 @@
+import asyncio
+import itertools
+import random
+import time
+from dataclasses import dataclass, field
+
+
+class TokenBucket:
+    # Allows `rate` acquisitions per second on average, with bursts of up to
+    # `capacity`
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+@dataclass
+class SendResult:
+    sent: int = 0
+    failed: int = 0
+    requests: int = 0
+    retries: int = 0
+    seconds: float = 0.0
+    errors: list = field(default_factory=list)
+
+    @property
+    def messages_per_second(self):
+        return self.sent / self.seconds if self.seconds else 0.0
+
+
+def take_batch(iterator, batch_size):
+    return list(itertools.islice(iterator, batch_size))
+
+
+async def send_batches(
+    send_batch,
+    messages,
+    batch_size=500,
+    max_concurrency=4,
+    rate_limit=10.0,
+    max_retries=3,
+    backoff_seconds=0.5,
+    on_sent=None,
+):
+    # Sends messages in batches through the blocking send_batch(batch)
+    # callable, which returns one {"ErrorCode": ...} result per message. At
+    # most max_concurrency requests are in flight, requests start at no more
+    # than rate_limit per second, and failed requests are retried with
+    # exponential backoff. messages can be any iterable; it is only read a
+    # batch at a time as requests complete. on_sent(messages), if given, is
+    # called in a worker thread with the messages of each batch that were
+    # accepted. If on_sent raises, no further batches are started and the
+    # first error is raised once the batches in flight have finished.
+    result = SendResult()
+    bucket = TokenBucket(rate_limit)
+
+    async def send(batch):
+        for attempt in range(max_retries + 1):
+            await bucket.acquire()
+            result.requests += 1
+            try:
+                responses = await asyncio.to_thread(send_batch, batch)
+            except Exception as e:
+                if attempt == max_retries:
+                    result.failed += len(batch)
+                    result.errors.append(f"{type(e).__name__}: {e}")
+                    return
+                result.retries += 1
+                delay = backoff_seconds * 2**attempt
+                await asyncio.sleep(delay + random.uniform(0, delay))
+                continue
+
+            accepted = []
+            for message, response in zip(batch, responses):
+                if response.get("ErrorCode", 0) == 0:
+                    result.sent += 1
+                    accepted.append(message)
+                else:
+                    result.failed += 1
+                    result.errors.append(response.get("Message", "unknown error"))
+            if on_sent is not None and accepted:
+                await asyncio.to_thread(on_sent, accepted)
+            return
+
+    start = time.perf_counter()
+    messages = iter(messages)
+    in_flight = set()
+    failures = []
+
+    def reap(done):
+        for task in done:
+            if task.exception() is not None:
+                failures.append(task.exception())
+
+    while not failures:
+        if len(in_flight) >= max_concurrency:
+            done, in_flight = await asyncio.wait(
+                in_flight, return_when=asyncio.FIRST_COMPLETED
+            )
+            reap(done)
+            if failures:
+                break
+        # Building a batch may block on reading attachments
+        batch = await asyncio.to_thread(take_batch, messages, batch_size)
+        if not batch:
+            break
+        in_flight.add(asyncio.create_task(send(batch)))
+    if in_flight:
+        done, _ = await asyncio.wait(in_flight)
+        reap(done)
+    if failures:
+        raise failures[0]
+    result.seconds = time.perf_counter() - start
+    return result
@@ -0,0 +1,113 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+# Hot paths record how long they take into the recorder of the asset that is
+# running, if any. Outside of instrument() recording is a no-op, so resources
+# and helpers can be used on their own without any setup.
+
+# Set to a directory to also write a Chrome trace (chrome://tracing or
+# https://ui.perfetto.dev) of every instrumented asset run
+TRACE_DIR_ENV_VAR = "USER_REPORT_TRACE_DIR"
+
+_recorder = contextvars.ContextVar("user_report_recorder", default=None)
+
+
+class Recorder:
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.counters = Counter()
+        self.metadata = {}
+        self._events = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def add(self, name, start, seconds, **counters):
+        with self._lock:
+            self.durations[name].append(seconds)
+            for counter, value in counters.items():
+                self.counters[f"{name}_{counter}"] += value
+            self._events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start - self._origin) * 1e6,
+                    "dur": seconds * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": counters,
+                }
+            )
+
+    def summary(self):
+        # p50/p95/max in milliseconds for every timed hot path, plus counters
+        import numpy as np
+
+        summary = {}
+        for name, durations in sorted(self.durations.items()):
+            milliseconds = np.asarray(durations) * 1000
+            summary[f"{name}_ms"] = {
+                "count": len(durations),
+                "p50": round(float(np.percentile(milliseconds, 50)), 3),
+                "p95": round(float(np.percentile(milliseconds, 95)), 3),
+                "max": round(float(milliseconds.max()), 3),
+                "total": round(float(milliseconds.sum()), 3),
+            }
+        summary.update(sorted(self.counters.items()))
+        return summary
+
+    def write_trace(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self._events}, f)
+
+
+@contextmanager
+def span(name, **counters):
+    # Times the enclosed block as one `name` event
+    recorder = _recorder.get()
+    if recorder is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add(name, start, time.perf_counter() - start, **counters)
+
+
+def record(name, seconds, **counters):
+    # For durations measured elsewhere, e.g. in a worker process
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.add(name, time.perf_counter() - seconds, seconds, **counters)
+
+
+@contextmanager
+def instrument(context):
+    # Collects timings while the asset or op body runs and reports them,
+    # together with anything added to recorder.metadata, as the output's
+    # metadata. Dagster only accepts one add_output_metadata call per output,
+    # so instrumented assets report their own metadata through the recorder.
+    recorder = Recorder()
+    token = _recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorder.reset(token)
+
+    context.add_output_metadata({**recorder.metadata, **recorder.summary()})
+
+    trace_dir = os.environ.get(TRACE_DIR_ENV_VAR)
+    if trace_dir:
+        name = context.op.name
+        if context.has_partition_key:
+            name = f"{name}-{context.partition_key}"
+        path = Path(trace_dir) / f"{name}-{context.run_id}.json"
+        recorder.write_trace(path)
+        context.log.info(f"Wrote trace to {path}")
@@ -0,0 +1,249 @@
+import re
+from datetime import timedelta
+from typing import TYPE_CHECKING, Sequence
+
+import duckdb
+from dagster import InputContext, OutputContext, TimeWindow
+from dagster._core.storage.db_io_manager import DbIOManager, DbTypeHandler, TableSlice
+from dagster_duckdb import DuckDBIOManager
+from dagster_duckdb.io_manager import DuckDbClient
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+# pandas and pyarrow are only imported once the IO manager is set up for a
+# run, so loading the code location doesn't pay for them
+
+# A partition_expr that shifts a column by a fixed interval, like
+# "month_end - INTERVAL 1 DAY"
+_SHIFTED_COLUMN_EXPR = re.compile(
+    r"^\s*(\w+)\s*-\s*INTERVAL\s+'?(\d+)\s*(DAY|HOUR|MINUTE|SECOND)S?'?\s*$",
+    re.IGNORECASE,
+)
+
+DUCKDB_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _shifted_time_window_where_clause(table_slice):
+    # The partition's time window as a condition on the bare column, with the
+    # partition_expr's shift applied to the window instead. DuckDB pushes a
+    # bare column comparison into the table scan and skips row groups by
+    # their min/max, where `month_end - INTERVAL 1 DAY >= ...` has to compute
+    # the expression for every row. None if that rewrite doesn't apply.
+    conditions = []
+    for dimension in table_slice.partition_dimensions:
+        match = _SHIFTED_COLUMN_EXPR.match(dimension.partition_expr)
+        if not isinstance(dimension.partitions, TimeWindow) or match is None:
+            return None
+        column, amount, unit = match.groups()
+        shift = timedelta(**{f"{unit.lower()}s": int(amount)})
+        start, end = (
+            (dt + shift).strftime(DUCKDB_DATETIME_FORMAT) for dt in dimension.partitions
+        )
+        conditions.append(f"{column} >= '{start}' AND {column} < '{end}'")
+    return " AND\n".join(conditions)
+
+
+class DuckDbPushdownClient(DuckDbClient):
+    # Selects and replaces partitions with conditions DuckDB can push down,
+    # see _shifted_time_window_where_clause. Selected columns come from the
+    # input's "columns" metadata, e.g. AssetIn(metadata={"columns": [...]}).
+    # Inputs with "arrow": True in their metadata are loaded as pyarrow
+    # Tables, see SortingDbIOManager.
+
+    @staticmethod
+    def delete_table_slice(context: OutputContext, table_slice: TableSlice, connection):
+        where = (
+            _shifted_time_window_where_clause(table_slice)
+            if table_slice.partition_dimensions
+            else None
+        )
+        if where is None:
+            return DuckDbClient.delete_table_slice(context, table_slice, connection)
+        try:
+            connection.execute(
+                f"DELETE FROM {table_slice.schema}.{table_slice.table} WHERE\n{where}"
+            )
+        except duckdb.CatalogException:
+            # table doesn't exist yet, so ignore the error
+            pass
+
+    @staticmethod
+    def get_select_statement(table_slice: TableSlice) -> str:
+        where = (
+            _shifted_time_window_where_clause(table_slice)
+            if table_slice.partition_dimensions
+            else None
+        )
+        if where is None:
+            return DuckDbClient.get_select_statement(table_slice)
+        columns = ", ".join(table_slice.columns) if table_slice.columns else "*"
+        return (
+            f"SELECT {columns} FROM {table_slice.schema}.{table_slice.table} WHERE\n"
+            + where
+        )
+
+
+def _sort_rows(obj, sort_by):
+    if hasattr(obj, "sort_values"):
+        return obj.sort_values(list(sort_by), kind="stable", ignore_index=True)
+    if hasattr(obj, "sort_by"):
+        return obj.sort_by([(column, "ascending") for column in sort_by])
+    # Record batch readers are ordered by DuckDB as they are written, see
+    # DuckDBArrowTypeHandler
+    return obj
+
+
+class SortingDbIOManager(DbIOManager):
+    # Stores outputs ordered by the asset's "sort_by" metadata. Partitions
+    # are appended in time order, so with sort_by=["month_end", ...] every
+    # row group covers a narrow range of the sort key, and filters on it can
+    # skip most of the table.
+
+    def handle_output(self, context: OutputContext, obj):
+        sort_by = (context.metadata or {}).get("sort_by")
+        if sort_by and obj is not None:
+            obj = _sort_rows(obj, sort_by)
+        super().handle_output(context, obj)
+
+    def load_input(self, context: InputContext):
+        # Unannotated inputs are loaded as pandas DataFrames, unless their
+        # metadata asks for Arrow. Inputs aren't annotated pa.Table, so
+        # loading the code location doesn't import pyarrow.
+        if not (context.metadata or {}).get("arrow"):
+            return super().load_input(context)
+
+        import pyarrow as pa
+
+        table_slice = self._get_table_slice(context, context.upstream_output)
+        with self._db_client.connect(context, table_slice) as conn:
+            return self._handlers_by_type[pa.Table].load_input(
+                context, table_slice, conn
+            )
+
+
+class DuckDBArrowTypeHandler(DbTypeHandler["pa.Table"]):
+    # Stores and loads pyarrow Tables, which DuckDB reads and produces
+    # without converting through pandas. Also stores record batch readers,
+    # which DuckDB consumes a batch at a time, so an asset can write more rows
+    # than it could hold in memory.
+
+    def handle_output(
+        self,
+        context: OutputContext,
+        table_slice: TableSlice,
+        obj: "pa.Table",
+        connection,
+    ):
+        import pyarrow as pa
+
+        if isinstance(obj, pa.RecordBatchReader):
+            self._write_batches(context, table_slice, obj, connection)
+            return
+        if obj.num_rows == 0:
+            context.log.warning("Skipping DuckDB write for empty Arrow table.")
+        else:
+            connection.register("arrow_obj", obj)
+            try:
+                connection.execute(
+                    f"create table if not exists {table_slice.schema}.{table_slice.table}"
+                    " as select * from arrow_obj"
+                )
+                if not connection.fetchall():
+                    # table already existed, insert the data instead
+                    connection.execute(
+                        f"insert into {table_slice.schema}.{table_slice.table}"
+                        " select * from arrow_obj"
+                    )
+            finally:
+                connection.unregister("arrow_obj")
+
+        context.add_output_metadata(
+            {
+                "row_count": obj.num_rows,
+                "arrow_schema": str(obj.schema),
+            }
+        )
+
+    def _write_batches(self, context, table_slice, reader, connection):
+        import pyarrow as pa
+
+        table = f"{table_slice.schema}.{table_slice.table}"
+        num_rows = 0
+
+        def counted_batches():
+            nonlocal num_rows
+            for batch in reader:
+                num_rows += batch.num_rows
+                yield batch
+
+        # The table is created from the schema alone, since reading from the
+        # reader consumes it
+        connection.register("arrow_schema", reader.schema.empty_table())
+        connection.register(
+            "arrow_obj",
+            pa.RecordBatchReader.from_batches(reader.schema, counted_batches()),
+        )
+        try:
+            connection.execute(
+                f"create table if not exists {table} as select * from arrow_schema"
+            )
+            # DuckDB sorts out of core, spilling to disk beyond its memory limit
+            sort_by = (context.metadata or {}).get("sort_by")
+            order_by = f" order by {', '.join(sort_by)}" if sort_by else ""
+            connection.execute(f"insert into {table} select * from arrow_obj{order_by}")
+        finally:
+            connection.unregister("arrow_schema")
+            connection.unregister("arrow_obj")
+
+        context.add_output_metadata(
+            {
+                "row_count": num_rows,
+                "arrow_schema": str(reader.schema),
+            }
+        )
+
+    def load_input(
+        self, context: InputContext, table_slice: TableSlice, connection
+    ) -> "pa.Table":
+        import pyarrow as pa
+
+        if table_slice.partition_dimensions and len(context.asset_partition_keys) == 0:
+            return pa.table({})
+        return connection.execute(
+            DuckDbPushdownClient.get_select_statement(table_slice)
+        ).fetch_arrow_table()
+
+    @property
+    def supported_types(self):
+        import pyarrow as pa
+
+        return [pa.Table, pa.RecordBatchReader]
+
+
+class DuckDBPandasArrowIOManager(DuckDBIOManager):
+    # Outputs are stored by their runtime type, pandas DataFrames or Arrow
+    # tables and record batch readers. Inputs are loaded as pandas DataFrames,
+    # or as Arrow tables when their metadata has "arrow": True.
+
+    def create_io_manager(self, context) -> DbIOManager:
+        return SortingDbIOManager(
+            db_client=DuckDbPushdownClient(),
+            database=self.database,
+            schema=self.schema_,
+            type_handlers=self.type_handlers(),
+            default_load_type=self.default_load_type(),
+            io_manager_name="DuckDBIOManager",
+        )
+
+    @staticmethod
+    def type_handlers() -> Sequence[DbTypeHandler]:
+        from dagster_duckdb_pandas import DuckDBPandasTypeHandler
+
+        return [DuckDBPandasTypeHandler(), DuckDBArrowTypeHandler()]
+
+    @staticmethod
+    def default_load_type():
+        import pandas as pd
+
+        return pd.DataFrame
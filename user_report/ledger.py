@@ -0,0 +1,102 @@
+import hashlib
+import json
+
+# Records every report email the provider accepted, keyed by partition, host
+# and a hash of the email's content. send_emails_job checks it before sending,
+# so a retry or re-run only sends what is still missing, while a host whose
+# report changed (e.g. after a backfill) gets the new one.
+
+LEDGER_TABLE = "email_delivery"
+
+
+def content_hash(recipient_email, template, attachment_names):
+    return hashlib.sha256(
+        json.dumps(
+            [recipient_email, template, sorted(attachment_names)], sort_keys=True
+        ).encode()
+    ).hexdigest()
+
+
+def message_content_hash(message):
+    # content_hash of a message as built by EmailService.send_many
+    return content_hash(
+        message["To"],
+        message["TemplateModel"],
+        [attachment["Name"] for attachment in message["Attachments"]],
+    )
+
+
+def ensure_ledger_table(conn):
+    conn.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {LEDGER_TABLE} (
+            partition_key VARCHAR,
+            host_id BIGINT,
+            content_hash VARCHAR,
+            recipient_email VARCHAR,
+            sent_at TIMESTAMP DEFAULT current_timestamp,
+            PRIMARY KEY (partition_key, host_id, content_hash)
+        )
+        """
+    )
+
+
+def delivered_keys(conn, partition_key, keys):
+    # The (host_id, content_hash) pairs of keys that were already delivered
+    import pyarrow as pa
+
+    host_ids, hashes = zip(*keys) if keys else ((), ())
+    candidates = pa.table(
+        {
+            "host_id": pa.array(host_ids, pa.int64()),
+            "content_hash": pa.array(hashes, pa.string()),
+        }
+    )
+    conn.register("candidates", candidates)
+    try:
+        rows = conn.execute(
+            f"""
+            SELECT l.host_id, l.content_hash
+            FROM {LEDGER_TABLE} l
+            JOIN candidates c USING (host_id, content_hash)
+            WHERE l.partition_key = $partition_key
+            """,
+            {"partition_key": partition_key},
+        ).fetchall()
+    finally:
+        conn.unregister("candidates")
+    return set(rows)
+
+
+def record_deliveries(conn, partition_key, deliveries):
+    # deliveries are (host_id, content_hash, recipient_email) tuples, written
+    # in one statement
+    import pyarrow as pa
+
+    host_ids, hashes, recipients = zip(*deliveries)
+    batch = pa.table(
+        {
+            "partition_key": pa.array([partition_key] * len(host_ids), pa.string()),
+            "host_id": pa.array(host_ids, pa.int64()),
+            "content_hash": pa.array(hashes, pa.string()),
+            "recipient_email": pa.array(recipients, pa.string()),
+        }
+    )
+    conn.register("deliveries", batch)
+    try:
+        conn.execute(
+            f"""
+            INSERT OR IGNORE INTO {LEDGER_TABLE}
+                (partition_key, host_id, content_hash, recipient_email)
+            SELECT * FROM deliveries
+            """
+        )
+    finally:
+        conn.unregister("deliveries")
+
+
+def delivery_count(conn, partition_key):
+    return conn.execute(
+        f"SELECT count(*) FROM {LEDGER_TABLE} WHERE partition_key = $partition_key",
+        {"partition_key": partition_key},
+    ).fetchone()[0]
@@ -0,0 +1,331 @@
+import contextlib
+import fcntl
+import json
+import mmap
+import os
+import threading
+from collections import OrderedDict, defaultdict
+
+from . import instrumentation
+
+# Stores the files of each directory (a month of charts) in one append-only
+# pack file instead of one file each. A manifest log records the pack, offset
+# and length of every file, so reading a file is a dictionary lookup and a
+# slice of the memory-mapped pack.
+#
+# Writes are buffered and appended in batches. Each batch's packs are fsynced
+# before its manifest records are appended (and fsynced), so the manifest
+# never points at data that isn't on disk. A crash loses at most the
+# unflushed batch.
+#
+# Overwritten and deleted files leave dead bytes behind until compact()
+# copies the live files into a new generation of the pack.
+#
+# Several processes can share a directory (e.g. parallel partitions of
+# historical_bar_charts). Flushes and compactions hold an exclusive lock on
+# the directory and first catch up with the manifest, so they append after
+# and compact from what every process has written. Lookups that miss catch up
+# too, which picks up files written and packs rewritten by other processes.
+
+MANIFEST = "manifest.jsonl"
+LOCK = "manifest.lock"
+
+
+class MapCache:
+    # Keeps up to max_maps files memory-mapped, evicting the least recently
+    # used. Evicted maps aren't closed explicitly: memoryviews handed out over
+    # them stay valid, and the file is unmapped once the last one is released.
+    def __init__(self, max_maps=64):
+        self.max_maps = max_maps
+        self._maps = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, min_size=0):
+        # A map of path covering at least min_size bytes. Mapped files are
+        # only ever appended to or replaced, so a map that became too short
+        # is simply redone.
+        with self._lock:
+            file_map = self._maps.get(path)
+            if file_map is None or len(file_map) < min_size:
+                with open(path, "rb") as f:
+                    if not os.fstat(f.fileno()).st_size:
+                        # Empty files can't be mapped
+                        return b""
+                    file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[path] = file_map
+            self._maps.move_to_end(path)
+            while len(self._maps) > self.max_maps:
+                self._maps.popitem(last=False)
+            return file_map
+
+    def invalidate(self, path):
+        with self._lock:
+            self._maps.pop(path, None)
+
+    def clear(self):
+        with self._lock:
+            self._maps.clear()
+
+
+def _pack_directory(pack):
+    # "2023/08.3.pack" -> ("2023/08", 3)
+    directory, generation = pack.removesuffix(".pack").rsplit(".", 1)
+    return directory, int(generation)
+
+
+class PackStore:
+    def __init__(self, dir, batch_size=256, maps=None):
+        self.dir = dir
+        self.batch_size = batch_size
+        self.maps = maps if maps is not None else MapCache()
+        # filename -> (pack, offset, length) of everything flushed
+        self._entries = {}
+        # filename -> content, or None for a delete, of the current batch
+        self._pending = {}
+        self._packs = set()
+        self._generations = {}
+        # Inode of the manifest and how far into it has been read
+        self._manifest_inode = None
+        self._manifest_offset = 0
+        # Whether this store has written anything, i.e. has anything to compact
+        self.wrote = False
+        self._lock = threading.RLock()
+        self._refresh()
+
+    @property
+    def _manifest_path(self):
+        return os.path.join(self.dir, MANIFEST)
+
+    @contextlib.contextmanager
+    def _exclusive(self):
+        # Held by one process at a time, across all stores of the directory
+        os.makedirs(self.dir, exist_ok=True)
+        with open(os.path.join(self.dir, LOCK), "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def _refresh(self):
+        # Applies the records appended since the last read, or rereads the
+        # manifest if another process's compact() replaced it. A record still
+        # being appended is left for the next read.
+        try:
+            f = open(self._manifest_path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            if inode != self._manifest_inode:
+                self._entries.clear()
+                self._packs.clear()
+                self._generations.clear()
+                # Packs may have been removed and their names reused
+                self.maps.clear()
+                self._manifest_inode, self._manifest_offset = inode, 0
+            f.seek(self._manifest_offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            self._apply(json.loads(line))
+        self._manifest_offset += end
+
+    def _entry(self, filename):
+        # The flushed entry of filename, catching up with other processes if
+        # this store doesn't know it
+        if filename not in self._entries:
+            self._refresh()
+        return self._entries.get(filename)
+
+    def _apply(self, record):
+        name, pack = record["name"], record["pack"]
+        if pack is None:
+            self._entries.pop(name, None)
+            return
+        self._entries[name] = (pack, record["offset"], record["length"])
+        self._packs.add(pack)
+        directory, generation = _pack_directory(pack)
+        self._generations[directory] = max(
+            self._generations.get(directory, 0), generation
+        )
+
+    def _active_pack(self, filename):
+        directory = os.path.dirname(filename) or "root"
+        return f"{directory}.{self._generations.get(directory, 0)}.pack"
+
+    def _path(self, pack):
+        return os.path.join(self.dir, pack)
+
+    def write(self, filename, content):
+        with self._lock:
+            self._pending[filename] = bytes(content)
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+
+    def delete(self, filename):
+        with self._lock:
+            if self._entry(filename) is not None:
+                self._pending[filename] = None
+            else:
+                self._pending.pop(filename, None)
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            with self._exclusive():
+                self._flush_locked()
+
+    def _flush_locked(self):
+        # flush() for a caller holding _exclusive()
+        self._refresh()
+        if not self._pending:
+            return
+        records = []
+        files_by_pack = defaultdict(list)
+        for name, content in self._pending.items():
+            if content is None:
+                records.append({"name": name, "pack": None})
+            else:
+                files_by_pack[self._active_pack(name)].append((name, content))
+
+        with instrumentation.span("storage_flush", files=len(self._pending)):
+            for pack, files in files_by_pack.items():
+                path = self._path(pack)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "ab") as f:
+                    offset = f.tell()
+                    for name, content in files:
+                        f.write(content)
+                        records.append(
+                            {
+                                "name": name,
+                                "pack": pack,
+                                "offset": offset,
+                                "length": len(content),
+                            }
+                        )
+                        offset += len(content)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            with open(self._manifest_path, "ab") as f:
+                # Drop a record cut short by a crash, so the append starts
+                # on a fresh line
+                if f.tell() > self._manifest_offset:
+                    f.truncate(self._manifest_offset)
+                f.write(
+                    "".join(json.dumps(record) + "\n" for record in records).encode()
+                )
+                f.flush()
+                os.fsync(f.fileno())
+
+        self._refresh()
+        self._pending.clear()
+        self.wrote = True
+
+    def view(self, filename):
+        # A memoryview of the file's bytes in the mapped pack, without copying
+        with self._lock:
+            if filename in self._pending:
+                content = self._pending[filename]
+                if content is None:
+                    raise FileNotFoundError(filename)
+                return memoryview(content)
+            entry = self._entry(filename)
+            if entry is None:
+                raise FileNotFoundError(filename)
+            pack, offset, length = entry
+            if not length:
+                return memoryview(b"")
+            try:
+                pack_map = self.maps.get(self._path(pack), offset + length)
+            except FileNotFoundError:
+                # Another process compacted the pack since this store read
+                # the manifest
+                self._refresh()
+                if filename not in self._entries:
+                    raise
+                pack, offset, length = self._entries[filename]
+                pack_map = self.maps.get(self._path(pack), offset + length)
+            return memoryview(pack_map)[offset : offset + length]
+
+    def read(self, filename):
+        with self.view(filename) as view:
+            return bytes(view)
+
+    def exists(self, filename):
+        with self._lock:
+            if filename in self._pending:
+                return self._pending[filename] is not None
+            return self._entry(filename) is not None
+
+    def size(self, filename):
+        with self._lock:
+            if filename in self._pending and self._pending[filename] is not None:
+                return len(self._pending[filename])
+            if not self.exists(filename):
+                raise FileNotFoundError(filename)
+            return self._entries[filename][2]
+
+    def compact(self, max_dead_ratio=0.5):
+        # Rewrites every pack where more than max_dead_ratio of the bytes
+        # belong to overwritten or deleted files, and returns how many were
+        # rewritten. The new packs are fsynced before the manifest is
+        # replaced, and the old packs are removed only after that.
+        with self._lock, self._exclusive():
+            # Compacts what every process has written, not just this store
+            self._flush_locked()
+            live = defaultdict(list)
+            for name, (pack, offset, length) in self._entries.items():
+                live[pack].append((name, offset, length))
+
+            rewritten = {}
+            for pack in sorted(self._packs):
+                path = self._path(pack)
+                size = os.path.getsize(path) if os.path.exists(path) else 0
+                live_bytes = sum(length for _, _, length in live[pack])
+                if size - live_bytes <= size * max_dead_ratio:
+                    continue
+                directory, _ = _pack_directory(pack)
+                self._generations[directory] += 1
+                new_pack = f"{directory}.{self._generations[directory]}.pack"
+                rewritten[pack] = new_pack
+                if not live[pack]:
+                    continue
+                with open(path, "rb") as src, open(self._path(new_pack), "wb") as dst:
+                    for name, offset, length in live[pack]:
+                        src.seek(offset)
+                        self._entries[name] = (new_pack, dst.tell(), length)
+                        dst.write(src.read(length))
+                    dst.flush()
+                    os.fsync(dst.fileno())
+            if not rewritten:
+                return 0
+
+            tmp_path = f"{self._manifest_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                for name, (pack, offset, length) in self._entries.items():
+                    record = {
+                        "name": name,
+                        "pack": pack,
+                        "offset": offset,
+                        "length": length,
+                    }
+                    f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+                stat = os.fstat(f.fileno())
+                self._manifest_inode, self._manifest_offset = stat.st_ino, stat.st_size
+            os.replace(tmp_path, self._manifest_path)
+
+            for pack, new_pack in rewritten.items():
+                self.maps.invalidate(self._path(pack))
+                os.remove(self._path(pack))
+                self._packs.discard(pack)
+                if live[pack]:
+                    self._packs.add(new_pack)
+            return len(rewritten)
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self.maps.clear()
@@ -1,57 +1,493 @@
 from dagster import ConfigurableResource
+import asyncio
+import contextlib
 import duckdb
+import hashlib
+import json
 import os
+import random
+import threading
+import time
+import urllib.request
+from typing import Optional
 from pydantic import PrivateAttr
+from . import hosts, instrumentation, ledger
+from .email_sender import send_batches
+from .packs import MapCache, PackStore
+
+
+# Ways LocalFileStorage lays files out under its directory
+STORAGE_LAYOUTS = ("files", "sharded", "packed")
 
 
 class LocalFileStorage(ConfigurableResource):
     dir: str
+    # "files" stores each file at its own path. "sharded" spreads files over
+    # 256 hash-prefix directories, so no directory grows to hundreds of
+    # thousands of entries. "packed" appends each month's files to one pack
+    # file, see packs.PackStore.
+    layout: str = "files"
+    # Files written per fsync in the packed layout
+    batch_size: int = 256
+    # Files (or packs) kept memory-mapped for view()
+    max_open_maps: int = 64
+    _packs = PrivateAttr(default=None)
+    _maps = PrivateAttr(default=None)
+    _made_dirs: set = PrivateAttr(default_factory=set)
 
     def setup_for_execution(self, context) -> None:
+        if self.layout not in STORAGE_LAYOUTS:
+            raise ValueError(
+                f"Unknown storage layout {self.layout!r}, expected one of "
+                f"{list(STORAGE_LAYOUTS)}"
+            )
         os.makedirs(self.dir, exist_ok=True)
 
+    def teardown_after_execution(self, context) -> None:
+        if self._packs is not None:
+            self._packs.close()
+            # Steps that only read (e.g. send_email_shard) leave compaction
+            # to the ones that write
+            if self._packs.wrote:
+                self._packs.compact()
+
+    def _map_cache(self):
+        if self._maps is None:
+            self._maps = MapCache(self.max_open_maps)
+        return self._maps
+
+    def _pack_store(self):
+        # None unless the packed layout is used
+        if self.layout == "packed" and self._packs is None:
+            self._packs = PackStore(self.dir, self.batch_size, self._map_cache())
+        return self._packs
+
+    def _path(self, filename):
+        if self.layout == "sharded":
+            shard = hashlib.sha1(filename.encode()).hexdigest()[:2]
+            return f"{self.dir}/{shard}/{filename}"
+        return f"{self.dir}/{filename}"
+
     def write(self, filename, data):
-        dir_path = f"{self.dir}/{os.path.dirname(filename)}"
-        os.makedirs(dir_path, exist_ok=True)
+        content = data.read()
+        with instrumentation.span("storage_write", bytes=len(content)):
+            packs = self._pack_store()
+            if packs is not None:
+                packs.write(filename, content)
+                return
+
+            path = self._path(filename)
+            dir_path = os.path.dirname(path)
+            if dir_path not in self._made_dirs:
+                os.makedirs(dir_path, exist_ok=True)
+                self._made_dirs.add(dir_path)
+            # Replaced rather than rewritten in place, so maps of the
+            # previous file handed out by view() keep their content
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+            self._map_cache().invalidate(path)
 
-        with open(f"{self.dir}/{filename}", "wb") as f:
-            f.write(data.read())
+    def flush(self):
+        # Writes out the packed layout's current batch
+        packs = self._pack_store()
+        if packs is not None:
+            packs.flush()
 
     def read(self, filename):
-        with open(f"{self.dir}/{filename}", "rb") as image_file:
+        packs = self._pack_store()
+        if packs is not None:
+            return packs.read(filename)
+        with open(self._path(filename), "rb") as image_file:
             return image_file.read()
 
+    def view(self, filename):
+        # A read-only memoryview of the file, backed by a memory map instead
+        # of a copy. Release it (or use it as a context manager) once done,
+        # so evicted maps can be unmapped.
+        packs = self._pack_store()
+        if packs is not None:
+            return packs.view(filename)
+        return memoryview(self._map_cache().get(self._path(filename)))
+
+    def exists(self, filename):
+        packs = self._pack_store()
+        if packs is not None:
+            return packs.exists(filename)
+        return os.path.exists(self._path(filename))
+
+    def size(self, filename):
+        packs = self._pack_store()
+        if packs is not None:
+            return packs.size(filename)
+        return os.path.getsize(self._path(filename))
+
+    def delete(self, filename):
+        packs = self._pack_store()
+        if packs is not None:
+            packs.delete(filename)
+        elif self.exists(filename):
+            os.remove(self._path(filename))
+            self._map_cache().invalidate(self._path(filename))
+
+
+class ChartCache(ConfigurableResource):
+    # Index of stored charts by filename and content key. A chart whose key
+    # still matches can be reused from storage instead of being re-rendered.
+    # Losing an entry only costs a re-render, so the index is a plain JSON
+    # file replaced atomically on teardown.
+    index_path: str
+    max_age_days: int = 90
+    max_size_mb: int = 1024
+    _index: dict = PrivateAttr()
+
+    def setup_for_execution(self, context) -> None:
+        try:
+            with open(self.index_path) as f:
+                self._index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._index = {}
+
+    def teardown_after_execution(self, context) -> None:
+        self.flush()
+
+    def flush(self):
+        os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def lookup(self, storage, filename, key):
+        entry = self._index.get(filename)
+        if entry is None or entry["key"] != key or not storage.exists(filename):
+            return False
+        entry["used_at"] = time.time()
+        return True
+
+    def record(self, storage, filename, key):
+        now = time.time()
+        self._index[filename] = {
+            "key": key,
+            "size": storage.size(filename),
+            "written_at": now,
+            "used_at": now,
+        }
+
+    def evict(self, storage, keep=()):
+        # Drop charts older than max_age_days, then the least recently used
+        # ones until they fit in max_size_mb, and delete their files. Charts
+        # in keep are still referenced, by the current run or by a stored
+        # partition of historical_bar_charts or emails_to_send, so they are
+        # never dropped and don't count towards max_size_mb: the limits bound
+        # the charts nothing refers to any more.
+        keep = set(keep)
+        expired_before = time.time() - self.max_age_days * 24 * 60 * 60
+        evicted = {
+            filename
+            for filename, entry in self._index.items()
+            if entry["written_at"] < expired_before and filename not in keep
+        }
+        remaining = sorted(
+            (
+                item
+                for item in self._index.items()
+                if item[0] not in evicted and item[0] not in keep
+            ),
+            key=lambda item: item[1]["used_at"],
+        )
+        total_size = sum(entry["size"] for _, entry in remaining)
+        max_size = self.max_size_mb * 1024 * 1024
+        for filename, entry in remaining:
+            if total_size <= max_size:
+                break
+            evicted.add(filename)
+            total_size -= entry["size"]
+
+        for filename in evicted:
+            storage.delete(filename)
+            del self._index[filename]
+        return len(evicted)
+
+
+class HostCache(ConfigurableResource):
+    # Host name and email lookups from an index that is only rebuilt when the
+    # host table changes, see hosts.py
+    dir: str
+
+    def lookup(self, database, host_ids):
+        # Arrow table of id, name and email for each of host_ids, in order
+        marker = hosts.host_change_marker(database)
+        path = os.path.join(self.dir, f"hosts-{marker}.arrow")
+        if not os.path.exists(path):
+            hosts.build_host_index(database, path)
+            # Finished indexes of earlier versions of the host table. Temporary
+            # files belong to builds still running in other processes, and
+            # another process may be removing the same index.
+            for filename in os.listdir(self.dir):
+                if (
+                    filename.startswith("hosts-")
+                    and filename.endswith(".arrow")
+                    and filename != os.path.basename(path)
+                ):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(os.path.join(self.dir, filename))
+        with instrumentation.span("host_lookup", hosts=len(host_ids)):
+            return hosts.lookup_hosts(hosts.load_host_index(path), host_ids)
+
+
+def duckdb_connection_config():
+    # DuckDB rejects a second connection to an open file unless both use the
+    # same configuration. The DuckDB IO manager connects to the same file
+    # during the run and tags its connections on DuckDB 1.0+.
+    if int(duckdb.__version__.split(".")[0]) >= 1:
+        return {"custom_user_agent": "dagster"}
+    return {}
+
+
+def connect_duckdb(path, lock_timeout):
+    # DuckDB lets one process at a time open a file for writing. While
+    # another process holds it, retry with jittered backoff for up to
+    # lock_timeout seconds.
+    deadline = time.monotonic() + lock_timeout
+    delay = 0.05
+    while True:
+        try:
+            return duckdb.connect(path, config=duckdb_connection_config())
+        except duckdb.IOException as e:
+            if "lock" not in str(e) or time.monotonic() >= deadline:
+                raise
+            time.sleep(delay + random.uniform(0, delay))
+            delay = min(delay * 2, 1.0)
+
 
 class Database(ConfigurableResource):
     path: str
+    # DuckDB settings for the run, DuckDB's defaults are used when unset
+    threads: Optional[int] = None
+    memory_limit: Optional[str] = None
+    # How long the first query of a step waits for another process (e.g. a
+    # concurrent run) to release the database file
+    lock_timeout: float = 600.0
+    _conn = PrivateAttr(default=None)
+    _cursors = PrivateAttr(default_factory=threading.local)
+    _open_cursors: list = PrivateAttr(default_factory=list)
+    _lock = PrivateAttr(default_factory=threading.Lock)
+    _query_timings: list = PrivateAttr(default_factory=list)
+
+    def teardown_after_execution(self, context) -> None:
+        self.close()
+
+    def _cursor(self):
+        # The connection is opened by the first query rather than at resource
+        # setup, so steps that never query don't take the file's lock. It is
+        # then kept open for the rest of the step so DuckDB's buffer cache
+        # survives between queries. Each thread gets its own cursor on it,
+        # since a DuckDB connection is not safe to share across threads.
+        from .distance import HAVERSINE_SQL_MACRO
+
+        cursor = getattr(self._cursors, "cursor", None)
+        if cursor is not None:
+            return cursor
+
+        with self._lock:
+            if self._conn is None:
+                self._conn = connect_duckdb(self.path, self.lock_timeout)
+                # Settings are applied with SET rather than connect() config,
+                # so other connections to the same file (e.g. the IO manager)
+                # are not rejected for having a different configuration
+                if self.threads is not None:
+                    self._conn.execute(f"SET threads = {int(self.threads)}")
+                if self.memory_limit is not None:
+                    self._conn.execute("SET memory_limit = ?", [self.memory_limit])
+            cursor = self._conn.cursor()
+            self._open_cursors.append(cursor)
+        cursor.execute(HAVERSINE_SQL_MACRO)
+        self._cursors.cursor = cursor
+        return cursor
+
+    def _execute(self, body, params, fetch):
+        cursor = self._cursor()
+        start = time.perf_counter()
+        result = fetch(cursor.execute(body, params))
+        seconds = time.perf_counter() - start
+        self._query_timings.append(seconds)
+        instrumentation.record("query", seconds)
+        return result
+
+    def query(self, body: str, params=None):
+        # params are bound to ? or $name placeholders in body
+        return self._execute(body, params, lambda result: result.df())
+
+    def execute(self, body: str, params=None):
+        # For statements that return nothing, e.g. DDL or inserts
+        self._execute(body, params, lambda result: None)
+
+    def query_arrow(self, body: str, params=None):
+        # Returns a pyarrow Table, skipping the conversion to pandas
+        return self._execute(body, params, lambda result: result.fetch_arrow_table())
+
+    def query_batches(self, body: str, params=None, batch_size=1_000_000):
+        # Returns a pyarrow RecordBatchReader that produces the result
+        # batch_size rows at a time. The reader uses this thread's cursor, so
+        # consume it before issuing the next query.
+        return self._execute(
+            body, params, lambda result: result.fetch_record_batch(batch_size)
+        )
+
+    @property
+    def query_timings(self):
+        # Seconds spent in each query issued through this resource
+        return list(self._query_timings)
 
-    def query(self, body: str):
-        with duckdb.connect(self.path) as conn:
-            return conn.query(body).to_df()
+    def close(self):
+        with self._lock:
+            for cursor in self._open_cursors:
+                cursor.close()
+            self._open_cursors.clear()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            self._cursors = threading.local()
+
+
+class DeliveryLedger(ConfigurableResource):
+    # Which report emails were delivered, see ledger.py. Every call opens its
+    # own short connection, so the send steps of a multiprocess run take turns
+    # at DuckDB's file lock instead of one step holding it for the whole send.
+    path: str
+    # How long to keep retrying while another process holds the lock
+    lock_timeout: float = 60.0
+    _lock = PrivateAttr(default_factory=threading.Lock)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        with self._lock:
+            conn = connect_duckdb(self.path, self.lock_timeout)
+            try:
+                ledger.ensure_ledger_table(conn)
+                yield conn
+            finally:
+                conn.close()
+
+    def delivered(self, partition_key, keys):
+        # The (host_id, content_hash) pairs of keys that were already
+        # delivered for the partition, checked in one query
+        with self._connect() as conn:
+            return ledger.delivered_keys(conn, partition_key, keys)
+
+    def record(self, partition_key, deliveries):
+        # deliveries are (host_id, content_hash, recipient_email) tuples
+        if not deliveries:
+            return
+        with instrumentation.span("ledger_write", deliveries=len(deliveries)):
+            with self._connect() as conn:
+                ledger.record_deliveries(conn, partition_key, deliveries)
+
+    def delivery_count(self, partition_key):
+        with self._connect() as conn:
+            return ledger.delivery_count(conn, partition_key)
 
 
 class EmailClient:
-    def __init__(self, server_token):
-        pass
+    # Without an api_url the client only prints what it would send, which is
+    # what local development uses
+    def __init__(self, server_token, api_url=None, timeout=30):
+        self.server_token = server_token
+        self.api_url = api_url
+        self.timeout = timeout
 
     def send(self, sender_email, recipient_email, template_id, template, attachments):
-        print(sender_email, recipient_email, template_id, template)
+        return self.send_batch(
+            [
+                {
+                    "From": sender_email,
+                    "To": recipient_email,
+                    "TemplateId": template_id,
+                    "TemplateModel": template,
+                    "Attachments": attachments,
+                }
+            ]
+        )[0]
+
+    def send_batch(self, messages):
+        if self.api_url is None:
+            for message in messages:
+                print(
+                    message["From"],
+                    message["To"],
+                    message["TemplateId"],
+                    message["TemplateModel"],
+                )
+            return [{"ErrorCode": 0} for _ in messages]
+
+        request = urllib.request.Request(
+            f"{self.api_url}/email/batchWithTemplates",
+            data=json.dumps({"Messages": messages}).encode(),
+            headers={
+                "Accept": "application/json",
+                "Content-Type": "application/json",
+                "X-Postmark-Server-Token": self.server_token,
+            },
+            method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.load(response)
 
 
 class EmailService(ConfigurableResource):
     template_id: int
     sender_email: str
     server_token: str
+    api_url: Optional[str] = None
+    # Messages per provider request, and how many requests may be in flight
+    batch_size: int = 500
+    max_concurrency: int = 4
+    # Provider requests started per second
+    rate_limit: float = 10.0
+    max_retries: int = 3
     _client: EmailClient = PrivateAttr()
 
     def setup_for_execution(self, context) -> None:
-        self._client = EmailClient(server_token=self.server_token)
+        self._client = EmailClient(server_token=self.server_token, api_url=self.api_url)
 
     def send(self, recipient_email, template, attachments):
-        self._client.send(
-            sender_email=self.sender_email,
-            recipient_email=recipient_email,
-            template_id=self.template_id,
-            template=template,
-            attachments=attachments,
+        with instrumentation.span("email_send", messages=1):
+            self._client.send(
+                sender_email=self.sender_email,
+                recipient_email=recipient_email,
+                template_id=self.template_id,
+                template=template,
+                attachments=attachments,
+            )
+
+    def _send_batch(self, messages):
+        with instrumentation.span("email_send", messages=len(messages)):
+            return self._client.send_batch(messages)
+
+    def send_many(self, emails, on_sent=None):
+        # emails is an iterable of (recipient_email, template, attachments)
+        # tuples, consumed lazily as batches are sent. on_sent is called with
+        # the messages of each request the provider accepted.
+        messages = (
+            {
+                "From": self.sender_email,
+                "To": recipient_email,
+                "TemplateId": self.template_id,
+                "TemplateModel": template,
+                "Attachments": attachments,
+            }
+            for recipient_email, template, attachments in emails
+        )
+        return asyncio.run(
+            send_batches(
+                self._send_batch,
+                messages,
+                batch_size=self.batch_size,
+                max_concurrency=self.max_concurrency,
+                rate_limit=self.rate_limit,
+                max_retries=self.max_retries,
+                on_sent=on_sent,
+            )
         )
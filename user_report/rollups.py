@@ -0,0 +1,198 @@
+import functools
+
+# Per-market summaries of property metrics that merge without the property
+# rows. Each (market, period, metric) row holds the count, sum, min and max of
+# the metric and a histogram over bin edges that are fixed per metric rather
+# than derived from the data, so histograms of different months and markets
+# line up bin by bin. Combining months into a quarter or a year is then a sum
+# of counts, sums and histograms, and a percentile is a cumulative sum over
+# one histogram.
+#
+# Changing a metric's bins makes its stored rollups unmergeable with new ones,
+# so the rollup tables have to be rebuilt after such a change.
+
+# metric -> (spacing, first edge, last edge, number of bins). Revenue (in
+# cents) spans several orders of magnitude and gets log-spaced bins, so its
+# percentiles are within one bin (12%) of the exact value at any scale.
+HISTOGRAM_BINS = {
+    "total_revenue": ("log", 100, 1e9, 140),
+    "occupancy_rate": ("linear", 0, 1, 50),
+    "stars": ("linear", 1, 5, 40),
+}
+
+MARKET_METRICS = list(HISTOGRAM_BINS)
+
+ROLLUP_PERCENTILES = [25, 50, 75, 90]
+
+
+@functools.lru_cache
+def histogram_edges(metric):
+    import numpy as np
+
+    spacing, first, last, num_bins = HISTOGRAM_BINS[metric]
+    if spacing == "log":
+        return np.geomspace(first, last, num_bins + 1)
+    return np.linspace(first, last, num_bins + 1)
+
+
+def bin_indices(metric, values):
+    # Values outside the edges count towards the first or last bin, the exact
+    # extremes are kept by min and max
+    import numpy as np
+
+    edges = histogram_edges(metric)
+    return np.clip(np.searchsorted(edges, values, side="right") - 1, 0, len(edges) - 2)
+
+
+def rollup_metric(metric, groups, num_groups, values):
+    # count, sum, min, max and histograms of values per group, where groups
+    # holds each value's group number. Missing values are left out.
+    import numpy as np
+
+    valid = ~np.isnan(values)
+    groups, values = groups[valid], values[valid]
+    num_bins = HISTOGRAM_BINS[metric][3]
+    minimum = np.full(num_groups, np.inf)
+    np.minimum.at(minimum, groups, values)
+    maximum = np.full(num_groups, -np.inf)
+    np.maximum.at(maximum, groups, values)
+    histograms = np.bincount(
+        groups * num_bins + bin_indices(metric, values),
+        minlength=num_groups * num_bins,
+    ).reshape(num_groups, num_bins)
+    return {
+        "count": np.bincount(groups, minlength=num_groups),
+        "sum": np.bincount(groups, weights=values, minlength=num_groups),
+        "min": minimum,
+        "max": maximum,
+        "histogram": histograms,
+    }
+
+
+def histogram_percentiles(metric, histograms, minimum, maximum, percentiles):
+    # Percentiles of the values behind each row of histograms, interpolated
+    # within the bin they fall in and clamped to the row's min and max. Rows
+    # without values get NaN.
+    import numpy as np
+
+    edges = histogram_edges(metric)
+    counts = histograms.sum(axis=1)
+    cumulative = np.cumsum(histograms, axis=1)
+    result = np.full((len(histograms), len(percentiles)), np.nan)
+    rows = np.flatnonzero(counts)
+    for i, percentile in enumerate(percentiles):
+        target = counts[rows] * percentile / 100
+        bins = np.argmax(cumulative[rows] >= target[:, None], axis=1)
+        below = cumulative[rows, bins] - histograms[rows, bins]
+        fraction = (target - below) / histograms[rows, bins]
+        low, high = edges[bins], edges[bins + 1]
+        if HISTOGRAM_BINS[metric][0] == "log":
+            value = low * (high / low) ** fraction
+        else:
+            value = low + (high - low) * fraction
+        result[rows, i] = np.clip(value, minimum[rows], maximum[rows])
+    return result
+
+
+def rollup_table(keys, period_column, period_end, metrics):
+    # Arrow rollup rows from {metric: rollup_metric(...)}, one per key and
+    # metric. Rows without values get nulls instead of the empty min and max.
+    import numpy as np
+    import pyarrow as pa
+
+    columns = {
+        "market_name": [],
+        "metric": [],
+        "count": [],
+        "sum": [],
+        "min": [],
+        "max": [],
+        "histogram": [],
+        **{f"p{percentile}": [] for percentile in ROLLUP_PERCENTILES},
+    }
+    for metric, rollup in metrics.items():
+        empty = rollup["count"] == 0
+        percentiles = histogram_percentiles(
+            metric,
+            rollup["histogram"],
+            rollup["min"],
+            rollup["max"],
+            ROLLUP_PERCENTILES,
+        )
+        columns["market_name"].append(pa.array(keys, pa.string()))
+        columns["metric"].append(pa.array(np.full(len(keys), metric), pa.string()))
+        columns["count"].append(pa.array(rollup["count"], pa.int64()))
+        columns["sum"].append(pa.array(rollup["sum"], pa.float64()))
+        columns["min"].append(pa.array(rollup["min"], pa.float64(), mask=empty))
+        columns["max"].append(pa.array(rollup["max"], pa.float64(), mask=empty))
+        columns["histogram"].append(
+            pa.array(list(rollup["histogram"]), pa.list_(pa.int64()))
+        )
+        for i, percentile in enumerate(ROLLUP_PERCENTILES):
+            columns[f"p{percentile}"].append(
+                pa.array(percentiles[:, i], pa.float64(), mask=empty)
+            )
+    num_rows = len(keys) * len(metrics)
+    table = pa.table(
+        {name: pa.concat_arrays(arrays) for name, arrays in columns.items()}
+    )
+    period = pa.array(
+        np.full(num_rows, period_end.to_datetime64()),
+        type=pa.timestamp("ns", tz="UTC"),
+    )
+    return table.add_column(1, period_column, period)
+
+
+def market_rollup(property_analytics, period_end):
+    # Rollup rows of every market for one month of property_analytics, an
+    # Arrow table. Missing values become NaN, which rollup_metric leaves out.
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    market_names = property_analytics["market_name"]
+    markets = pc.unique(market_names)
+    markets = markets.take(pc.array_sort_indices(markets))
+    codes = pc.index_in(market_names, value_set=markets).to_numpy()
+    metrics = {
+        metric: rollup_metric(
+            metric,
+            codes,
+            len(markets),
+            pc.cast(property_analytics[metric], pa.float64()).to_numpy(),
+        )
+        for metric in MARKET_METRICS
+    }
+    return rollup_table(markets.to_pylist(), "month_end", period_end, metrics)
+
+
+def merge_rollups(rollups, period_end):
+    # Combines rollup rows of any months (e.g. a quarter's) into one row per
+    # market and metric, without the property rows behind them
+    import numpy as np
+    import pandas as pd
+
+    metrics = {}
+    markets = sorted(rollups["market_name"].unique())
+    for metric in MARKET_METRICS:
+        rows = rollups[rollups["metric"] == metric]
+        groups = pd.Categorical(rows["market_name"], categories=markets).codes
+        num_bins = HISTOGRAM_BINS[metric][3]
+        histograms = np.zeros((len(markets), num_bins), dtype=np.int64)
+        if len(rows):
+            np.add.at(histograms, groups, np.stack(rows["histogram"].to_numpy()))
+        minimum = np.full(len(markets), np.inf)
+        np.minimum.at(minimum, groups, rows["min"].fillna(np.inf).to_numpy())
+        maximum = np.full(len(markets), -np.inf)
+        np.maximum.at(maximum, groups, rows["max"].fillna(-np.inf).to_numpy())
+        metrics[metric] = {
+            "count": np.bincount(
+                groups, weights=rows["count"].to_numpy(), minlength=len(markets)
+            ).astype(np.int64),
+            "sum": np.bincount(
+                groups, weights=rows["sum"].to_numpy(), minlength=len(markets)
+            ),
+            "min": minimum,
+            "max": maximum,
+            "histogram": histograms,
+        }
+    return rollup_table(markets, "period_end", period_end, metrics)
@@ -0,0 +1,89 @@
+# Tracks, per monthly partition, the newest reservation that property_analytics
+# has already aggregated. Reservations beyond the watermark (a higher id or a
+# later created_at) are the ones an incremental run has to pick up.
+#
+# The watermark is stored in the metadata of the materialization it belongs
+# to, so it only moves forward once the IO manager has stored the rows it
+# describes. It is taken from the same rows that were aggregated: the
+# reservation table when the run queries it, or the monthly_reservations
+# snapshot when the run aggregates that.
+
+WATERMARK_METADATA_KEY = "watermark"
+
+
+def _watermark_row(database, query, params):
+    row = database.query_arrow(query, params).to_pylist()[0]
+    created_at = row["max_created_at"]
+    return {
+        "max_reservation_id": row["max_reservation_id"],
+        # Kept as text, so it fits in JSON metadata
+        "max_created_at": None if created_at is None else str(created_at),
+    }
+
+
+def current_watermark(database, params):
+    # params binds $start and $end like reservations_params()
+    return _watermark_row(
+        database,
+        """
+        SELECT max(id) AS max_reservation_id, max(created_at) AS max_created_at
+        FROM reservation
+        WHERE end_date >= $start AND end_date < $end
+        """,
+        params,
+    )
+
+
+def snapshot_watermark(database, month_end):
+    # The watermark of the partition's rows in monthly_reservations
+    return _watermark_row(
+        database,
+        """
+        SELECT max(id) AS max_reservation_id, max(created_at) AS max_created_at
+        FROM monthly_reservations
+        WHERE month_end = $month_end
+        """,
+        {"month_end": month_end},
+    )
+
+
+def read_watermark(instance, asset_key, partition_key):
+    # The watermark of the partition's latest materialization, or None if it
+    # has none (e.g. it predates watermarks)
+    from dagster import DagsterEventType, EventRecordsFilter
+
+    records = instance.get_event_records(
+        EventRecordsFilter(
+            event_type=DagsterEventType.ASSET_MATERIALIZATION,
+            asset_key=asset_key,
+            asset_partitions=[partition_key],
+        ),
+        limit=1,
+        ascending=False,
+    )
+    if not records:
+        return None
+    materialization = records[0].event_log_entry.asset_materialization
+    watermark = materialization.metadata.get(WATERMARK_METADATA_KEY)
+    return None if watermark is None else watermark.value
+
+
+def changed_property_ids(database, params, watermark):
+    # Properties with reservations in the window that arrived after the
+    # watermark was taken
+    return database.query_arrow(
+        """
+            SELECT DISTINCT property_id
+            FROM reservation
+            WHERE
+                end_date >= $start AND end_date < $end
+                AND (
+                    id > coalesce($max_reservation_id, -1)
+                    OR created_at > coalesce(
+                        $max_created_at::TIMESTAMP, TIMESTAMP '-infinity'
+                    )
+                )
+                AND property_id IS NOT NULL
+            """,
+        {**params, **watermark},
+    )["property_id"].to_pylist()
@@ -1 +1,942 @@
+import asyncio
+import base64
+import io
+import itertools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+import duckdb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+from dagster import DagsterInstance, TimeWindow, materialize
+from dagster._core.storage.db_io_manager import TablePartitionDimension, TableSlice
+from dagster_duckdb.io_manager import DuckDbClient
+from geopy.distance import geodesic, great_circle
+
+from user_report import (
+    charts,
+    charts_lite,
+    email_sender,
+    instrumentation,
+    ledger,
+    rollups,
+    watermarks,
+)
+from user_report.assets import (
+    aggregate_reservations,
+    market_analytics,
+    merge_aggregates,
+    monthly_reservations,
+    property_analytics,
+    property_metrics,
+    shard_emails_by,
+    stored_chart_paths,
+    with_distance,
+)
+from user_report.attachments import encode_attachments
+from user_report.charts_matplotlib import LineChartRenderer
+from user_report.distance import GEODESIC_TOLERANCE_MILES, distance_miles
+from user_report.io_managers import DuckDBPandasArrowIOManager, DuckDbPushdownClient
+from user_report.resources import (
+    ChartCache,
+    Database,
+    DeliveryLedger,
+    EmailService,
+    HostCache,
+    LocalFileStorage,
+)
+
+
+POINTS = [
+    (30.2506, -97.7494, 36.1522, -86.7867),
+    (47.6230, -122.3194, 47.6230, -122.3194),
+    (0.0, 0.0, 0.0, 90.0),
+    (0.0, 0.0, 0.5, 179.7),
+    (-33.8688, 151.2093, 51.5074, -0.1278),
+]
+
+
+def test_geodesic_distance_matches_geopy():
+    lat1, lon1, lat2, lon2 = map(np.array, zip(*POINTS))
+    expected = [geodesic((a, b), (c, d)).miles for a, b, c, d in POINTS]
+    result = distance_miles(lat1, lon1, lat2, lon2, method="geodesic")
+    np.testing.assert_allclose(result, expected, rtol=0, atol=GEODESIC_TOLERANCE_MILES)
+
+
+def test_haversine_distance_matches_great_circle():
+    lat1, lon1, lat2, lon2 = map(np.array, zip(*POINTS))
+    expected = [great_circle((a, b), (c, d)).miles for a, b, c, d in POINTS]
+    result = distance_miles(lat1, lon1, lat2, lon2, method="haversine")
+    np.testing.assert_allclose(result, expected, rtol=1e-9, atol=1e-9)
+
+
+def test_unknown_distance_method():
+    with pytest.raises(ValueError):
+        distance_miles(0, 0, 0, 0, method="manhattan")
+
+
+def test_chart_cache_hits_and_evicts(tmp_path):
+    storage = LocalFileStorage(dir=str(tmp_path / "charts"))
+    cache = ChartCache(index_path=str(tmp_path / "index.json"), max_size_mb=0)
+    cache.setup_for_execution(None)
+
+    for filename in ["2023/05/a.png", "2023/05/b.png", "2023/05/c.png"]:
+        storage.write(filename, io.BytesIO(b"png"))
+        cache.record(storage, filename, "key")
+
+    assert cache.lookup(storage, "2023/05/a.png", "key")
+    assert not cache.lookup(storage, "2023/05/a.png", "other-key")
+
+    # A stored partition still refers to c.png
+    database = Database(path=str(tmp_path / "test.duckdb"))
+    database.execute(
+        """
+        CREATE TABLE historical_bar_charts AS
+        SELECT '2023/05/c.png' AS total_revenue_chart, NULL AS stars_chart
+        """
+    )
+    stored = stored_chart_paths(database)
+    assert stored == {"2023/05/c.png"}
+
+    # Over the size budget, everything but the referenced charts goes
+    assert cache.evict(storage, keep=stored | {"2023/05/b.png"}) == 1
+    assert not storage.exists("2023/05/a.png")
+    assert cache.lookup(storage, "2023/05/b.png", "key")
+    assert cache.lookup(storage, "2023/05/c.png", "key")
+
+    cache.flush()
+    reloaded = ChartCache(index_path=str(tmp_path / "index.json"), max_age_days=0)
+    reloaded.setup_for_execution(None)
+    time.sleep(0.01)
+    assert reloaded.evict(storage, keep=stored) == 1
+    assert not storage.exists("2023/05/b.png")
+    assert storage.read("2023/05/c.png") == b"png"
+    database.teardown_after_execution(None)
+
+
+def test_packed_storage_round_trips(tmp_path):
+    storage = LocalFileStorage(dir=str(tmp_path), layout="packed", batch_size=2)
+    contents = {
+        f"2023/0{m}/{i}.png": bytes([m, i]) * 10**i for m in (5, 6) for i in range(3)
+    }
+    for filename, content in contents.items():
+        storage.write(filename, io.BytesIO(content))
+    # The last file is still in the unflushed batch
+    assert storage.read("2023/06/2.png") == contents["2023/06/2.png"]
+
+    storage.write("2023/05/0.png", io.BytesIO(b"replaced"))
+    storage.delete("2023/05/2.png")
+    storage.flush()
+    contents["2023/05/0.png"] = b"replaced"
+    del contents["2023/05/2.png"]
+
+    reloaded = LocalFileStorage(dir=str(tmp_path), layout="packed")
+    assert not reloaded.exists("2023/05/2.png")
+    for filename, content in contents.items():
+        assert reloaded.read(filename) == content
+        assert reloaded.size(filename) == len(content)
+
+    # Teardown of a store that only read leaves the packs alone, the writer's
+    # compacts the May pack, which is mostly dead bytes
+    reloaded.teardown_after_execution(None)
+    assert (tmp_path / "2023" / "05.0.pack").exists()
+    storage.teardown_after_execution(None)
+    assert sorted(p.name for p in (tmp_path / "2023").iterdir()) == [
+        "05.1.pack",
+        "06.0.pack",
+    ]
+    compacted = LocalFileStorage(dir=str(tmp_path), layout="packed")
+    assert compacted.read("2023/05/1.png") == contents["2023/05/1.png"]
+
+
+def test_packed_storage_shared_between_processes(tmp_path):
+    # Two stores on one directory stand in for two processes
+    first = LocalFileStorage(dir=str(tmp_path), layout="packed", batch_size=1)
+    second = LocalFileStorage(dir=str(tmp_path), layout="packed", batch_size=1)
+    first.write("2023/05/a.png", io.BytesIO(b"a" * 100))
+    for content in (b"1", b"2", b"3"):
+        second.write("2023/06/b.png", io.BytesIO(content * 100))
+    second.teardown_after_execution(None)
+
+    assert (tmp_path / "2023" / "06.1.pack").exists()
+    # The compacted manifest keeps the other store's file, which both stores
+    # and a fresh one can read
+    for storage in (
+        first,
+        second,
+        LocalFileStorage(dir=str(tmp_path), layout="packed"),
+    ):
+        assert storage.read("2023/05/a.png") == b"a" * 100
+        assert storage.read("2023/06/b.png") == b"3" * 100
+
+    # Writes after the compaction append to the new generation
+    first.write("2023/06/c.png", io.BytesIO(b"c"))
+    first.teardown_after_execution(None)
+    assert second.read("2023/06/c.png") == b"c"
+    assert (
+        LocalFileStorage(dir=str(tmp_path), layout="packed").read("2023/06/b.png")
+        == b"3" * 100
+    )
+
+
+@pytest.fixture
+def email_provider():
+    # Stands in for the email provider's batch endpoint. The first request
+    # fails so the sender has to retry.
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if not received:
+                received.append(None)
+                self.send_response(503)
+                self.end_headers()
+                return
+            received.extend(body["Messages"])
+            response = json.dumps(
+                [{"ErrorCode": 0, "To": m["To"]} for m in body["Messages"]]
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}", received
+    server.shutdown()
+    server.server_close()
+
+
+def test_send_many_batches_and_retries(email_provider):
+    api_url, received = email_provider
+    email_service = EmailService(
+        template_id=1,
+        sender_email="reports@example.com",
+        server_token="token",
+        api_url=api_url,
+        batch_size=10,
+        rate_limit=1000,
+    )
+    email_service.setup_for_execution(None)
+
+    emails = [(f"host{i}@example.com", {"name": f"Host {i}"}, []) for i in range(95)]
+    result = email_service.send_many(emails)
+
+    assert result.sent == 95
+    assert result.failed == 0
+    assert result.retries == 1
+    assert result.requests == 11
+    assert sorted(m["To"] for m in received[1:]) == sorted(e[0] for e in emails)
+
+
+def test_delivery_ledger_records_accepted_emails(tmp_path, email_provider):
+    api_url, _ = email_provider
+    email_service = EmailService(
+        template_id=1,
+        sender_email="reports@example.com",
+        server_token="token",
+        api_url=api_url,
+        batch_size=10,
+        rate_limit=1000,
+    )
+    email_service.setup_for_execution(None)
+    # The ledger shares its file with a run's open database connection
+    database = Database(path=str(tmp_path / "test.duckdb"))
+    database.setup_for_execution(None)
+    database.execute("SELECT 1")
+    delivery_ledger = DeliveryLedger(path=str(tmp_path / "test.duckdb"))
+
+    emails = [(f"host{i}@example.com", {"name": f"Host {i}"}, []) for i in range(25)]
+    hashes = [ledger.content_hash(email, template, []) for email, template, _ in emails]
+    host_ids = {content_hash: i for i, content_hash in enumerate(hashes)}
+
+    def record_sent(messages):
+        delivery_ledger.record(
+            "2023-08-01",
+            [
+                (host_ids[h], h, m["To"])
+                for m, h in zip(messages, map(ledger.message_content_hash, messages))
+            ],
+        )
+
+    email_service.send_many(emails, on_sent=record_sent)
+    assert delivery_ledger.delivery_count("2023-08-01") == 25
+    assert delivery_ledger.delivery_count("2023-09-01") == 0
+
+    # A changed report for host 0 counts as not delivered
+    keys = list(enumerate(hashes)) + [(0, ledger.content_hash("x", {}, []))]
+    assert delivery_ledger.delivered("2023-08-01", keys) == set(keys[:25])
+
+    # Recording a delivery again is a no-op
+    record_sent(
+        [{"To": emails[0][0], "TemplateModel": emails[0][1], "Attachments": []}]
+    )
+    assert delivery_ledger.delivery_count("2023-08-01") == 25
+
+    # Host ids beyond the 32-bit range
+    big_key = (2**40, hashes[0])
+    delivery_ledger.record("2023-10-01", [(*big_key, emails[0][0])])
+    assert delivery_ledger.delivered("2023-10-01", [big_key]) == {big_key}
+    database.teardown_after_execution(None)
+
+
+def test_send_batches_raises_on_sent_failures():
+    recorded = []
+
+    def on_sent(messages):
+        if messages[0] == 20:
+            raise RuntimeError("ledger unavailable")
+        recorded.extend(messages)
+
+    def send_batch(batch):
+        return [{"ErrorCode": 0} for _ in batch]
+
+    with pytest.raises(RuntimeError, match="ledger unavailable"):
+        asyncio.run(
+            email_sender.send_batches(
+                send_batch,
+                range(1000),
+                batch_size=10,
+                max_concurrency=2,
+                rate_limit=1000,
+                on_sent=on_sent,
+            )
+        )
+    # Batches in flight still finish, but no new ones start after the failure
+    assert 0 < len(recorded) < 100
+
+
+@pytest.mark.parametrize("layout", ["files", "sharded", "packed"])
+def test_encode_attachments_matches_base64(tmp_path, layout):
+    # One open map at a time, so maps are evicted while the encoder runs
+    storage = LocalFileStorage(dir=str(tmp_path), layout=layout, max_open_maps=1)
+    sizes = {"empty.png": 0, "small.png": 1000, "large.png": 400_007}
+    contents = {}
+    for filename, size in sizes.items():
+        contents[filename] = np.random.default_rng(size).bytes(size)
+        storage.write(filename, io.BytesIO(contents[filename]))
+    storage.flush()
+
+    filenames = ["large.png", "empty.png", "large.png", "small.png", "large.png"]
+    encoded = list(encode_attachments(storage, filenames, prefetch=2))
+
+    assert encoded == [base64.b64encode(contents[f]).decode() for f in filenames]
+
+    # A view outlives the eviction of its map, and a rewrite of its file
+    view = storage.view("large.png")
+    storage.view("small.png")
+    storage.write("large.png", io.BytesIO(b"rewritten"))
+    storage.flush()
+    assert view == contents["large.png"]
+    assert storage.read("large.png") == b"rewritten"
+
+
+def test_database_keeps_one_connection(tmp_path):
+    database = Database(path=str(tmp_path / "test.duckdb"), threads=2)
+    database.setup_for_execution(None)
+    database.query("CREATE TABLE host AS SELECT range AS id FROM range(10)")
+
+    result = database.query(
+        "SELECT count(*) AS n FROM host WHERE id >= $min", {"min": 4}
+    )
+    assert result["n"].tolist() == [6]
+    assert database.query("SELECT current_setting('threads') AS t")["t"].tolist() == [2]
+    assert len(database.query_timings) == 3
+
+    table = database.query_arrow("SELECT id FROM host WHERE id < ?", [3])
+    assert table.column("id").to_pylist() == [0, 1, 2]
+    batches = database.query_batches("SELECT id FROM host", batch_size=4)
+    assert [batch.num_rows for batch in batches] == [4, 4, 2]
+
+    database.teardown_after_execution(None)
+    assert database._conn is None
+
+
+def test_database_waits_for_another_process_to_release_the_file(tmp_path):
+    path = str(tmp_path / "test.duckdb")
+    holder = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import duckdb, time; conn = duckdb.connect(%r); print(flush=True); "
+            "time.sleep(1)" % path,
+        ],
+        stdout=subprocess.PIPE,
+    )
+    holder.stdout.readline()
+
+    database = Database(path=path, lock_timeout=0)
+    # Setup doesn't connect, only the first query does
+    database.setup_for_execution(None)
+    with pytest.raises(duckdb.IOException):
+        database.execute("SELECT 1")
+
+    database = Database(path=path, lock_timeout=30)
+    assert database.query("SELECT 1 AS one")["one"].tolist() == [1]
+    assert holder.wait() == 0
+    database.teardown_after_execution(None)
+
+
+def test_host_cache_rebuilds_after_host_changes(tmp_path):
+    database = Database(path=str(tmp_path / "test.duckdb"))
+    database.execute(
+        """
+        CREATE TABLE host AS
+        SELECT range * 2 AS id, 'host ' || range AS name, range || '@example.com' AS email,
+            TIMESTAMP '2023-01-01' AS updated_at
+        FROM range(5)
+        """
+    )
+    cache = HostCache(dir=str(tmp_path / "hosts"))
+
+    found = cache.lookup(database, np.array([6, 3, 0]))
+    assert found["name"].to_pylist() == ["host 3", None, "host 0"]
+    (index_file,) = (tmp_path / "hosts").iterdir()
+    # Another process's build still in progress
+    in_progress = tmp_path / "hosts" / "hosts-other.arrow.123.tmp"
+    in_progress.write_bytes(b"")
+
+    database.execute(
+        "UPDATE host SET name = 'renamed', updated_at = TIMESTAMP '2023-02-01' WHERE id = 6"
+    )
+    assert cache.lookup(database, np.array([6]))["name"].to_pylist() == ["renamed"]
+    assert not index_file.exists()
+    assert in_progress.exists()
+
+
+def test_streamed_aggregates_match_in_memory():
+    rng = np.random.default_rng(0)
+    num_rows = 1000
+    reservations = pa.table(
+        {
+            "property_id": rng.integers(0, 50, num_rows),
+            "month_end": pa.array(
+                np.full(num_rows, np.datetime64("2023-06-01", "ns")),
+                type=pa.timestamp("ns", tz="UTC"),
+            ),
+            "market_name": rng.choice(["austin", "denver"], num_rows),
+            "host_id": rng.integers(0, 50, num_rows),
+            "total_cost": rng.integers(5_000, 300_000, num_rows).astype(np.float32),
+            "dist": pa.array(
+                rng.uniform(0, 300, num_rows), mask=rng.random(num_rows) < 0.1
+            ),
+            "nights": rng.integers(1, 7, num_rows),
+            "stars": pa.array(
+                rng.integers(1, 6, num_rows).astype(np.float32),
+                mask=rng.random(num_rows) < 0.4,
+            ),
+        }
+    )
+
+    def ordered(table):
+        return table.sort_by([(key, "ascending") for key in table.column_names])
+
+    partials = [aggregate_reservations(batch) for batch in reservations.to_batches(97)]
+    expected = aggregate_reservations(reservations)
+    assert ordered(merge_aggregates(partials)).equals(ordered(expected))
+
+    window = TimeWindow(
+        pd.Timestamp("2023-05-01", tz="UTC"), pd.Timestamp("2023-06-01", tz="UTC")
+    )
+    keys = ["property_id", "host_id", "market_name"]
+    metrics = property_metrics(expected, window).to_pandas().set_index(keys)
+    rows = reservations.to_pandas().groupby(keys)
+    assert metrics["stars"].to_dict() == pytest.approx(
+        rows["stars"].mean().to_dict(), nan_ok=True
+    )
+    assert metrics["occupancy_rate"].to_dict() == pytest.approx(
+        (rows["nights"].sum() / 31).clip(upper=1).to_dict()
+    )
+
+
+def test_merged_market_rollups_match_rollup_of_rows():
+    rng = np.random.default_rng(0)
+    months = []
+    for month in range(3):
+        num_rows = 500
+        months.append(
+            pd.DataFrame(
+                {
+                    "market_name": rng.choice(["austin", "denver", "miami"], num_rows),
+                    "total_revenue": rng.lognormal(13, 1, num_rows),
+                    "occupancy_rate": rng.uniform(0, 1, num_rows),
+                    # No ratings at all for denver in the first month
+                    "stars": rng.uniform(1, 5, num_rows),
+                }
+            )
+        )
+    months[0].loc[months[0]["market_name"] == "denver", "stars"] = np.nan
+    month_ends = pd.date_range("2023-05-01", periods=3, freq="MS", tz="UTC")
+    monthly = pd.concat(
+        [
+            rollups.market_rollup(pa.Table.from_pandas(rows), month_end).to_pandas()
+            for rows, month_end in zip(months, month_ends)
+        ]
+    )
+
+    quarter = rollups.merge_rollups(monthly, month_ends[-1]).to_pandas()
+    expected = rollups.market_rollup(
+        pa.Table.from_pandas(pd.concat(months), preserve_index=False), month_ends[-1]
+    ).to_pandas()
+    for column in ["market_name", "metric", "count", "min", "max"]:
+        assert quarter[column].tolist() == expected[column].tolist()
+    assert quarter["sum"].tolist() == pytest.approx(expected["sum"].tolist())
+    assert [list(h) for h in quarter["histogram"]] == [
+        list(h) for h in expected["histogram"]
+    ]
+
+    # Percentiles are within a bin of the exact ones
+    rows = pd.concat(months)
+    for metric in rollups.MARKET_METRICS:
+        edges = rollups.histogram_edges(metric)
+        for market, values in rows.groupby("market_name")[metric]:
+            exact = np.percentile(values.dropna(), rollups.ROLLUP_PERCENTILES)
+            row = quarter[
+                (quarter["market_name"] == market) & (quarter["metric"] == metric)
+            ]
+            bins = rollups.bin_indices(metric, exact)
+            width = edges[bins + 1] - edges[bins]
+            estimated = row[[f"p{p}" for p in rollups.ROLLUP_PERCENTILES]].to_numpy()[0]
+            assert np.all(np.abs(estimated - exact) <= width)
+
+
+def test_email_shards_partition_recipients():
+    emails = pd.DataFrame(
+        {
+            "host_id": range(100),
+            "market_name": [f"market-{i % 7}" for i in range(100)],
+        }
+    )
+
+    shards = shard_emails_by(emails, 8, "host_id")
+    assert len(shards) == 8
+    assert sorted(pd.concat(shards.values())["host_id"]) == list(range(100))
+    # Every run and process assigns hosts to the same shards
+    assert shards[3].equals(shard_emails_by(emails, 8, "host_id")[3])
+
+    by_market = shard_emails_by(emails, 8, "market_name")
+    markets = [set(rows["market_name"]) for rows in by_market.values()]
+    assert sum(len(m) for m in markets) == len(set.union(*markets)) == 7
+
+    with pytest.raises(ValueError):
+        shard_emails_by(emails, 8, "email")
+
+
+def test_pushdown_select_matches_partition_expr():
+    window = TimeWindow(
+        pd.Timestamp("2023-04-01", tz="UTC"), pd.Timestamp("2023-06-01", tz="UTC")
+    )
+    table_slice = TableSlice(
+        table="property_analytics",
+        schema="main",
+        partition_dimensions=[
+            TablePartitionDimension(
+                partition_expr="month_end - INTERVAL 1 DAY", partitions=window
+            )
+        ],
+        columns=["property_id", "month_end"],
+    )
+    conn = duckdb.connect()
+    conn.execute(
+        """
+        CREATE TABLE property_analytics AS
+        SELECT i AS property_id, TIMESTAMPTZ '2023-01-01' + to_months(i) AS month_end, i AS total_revenue
+        FROM range(12) r(i)
+        """
+    )
+
+    pushed_down = DuckDbPushdownClient.get_select_statement(table_slice)
+    assert "month_end - INTERVAL" not in pushed_down
+    assert (
+        conn.execute(pushed_down).fetchall()
+        == conn.execute(DuckDbClient.get_select_statement(table_slice)).fetchall()
+    )
+    assert [row[0] for row in conn.execute(pushed_down).fetchall()] == [4, 5]
+
+
+def test_watermark_finds_changed_properties(tmp_path):
+    database = Database(path=str(tmp_path / "test.duckdb"))
+    database.execute(
+        """
+        CREATE TABLE reservation AS
+        SELECT
+            range AS id,
+            range % 5 AS property_id,
+            TIMESTAMP '2023-05-10' AS end_date,
+            TIMESTAMP '2023-05-01' AS created_at
+        FROM range(20)
+        """
+    )
+    params = {"start": "2023-05-01", "end": "2023-06-01"}
+
+    watermark = watermarks.current_watermark(database, params)
+    assert watermark["max_reservation_id"] == 19
+    assert watermarks.changed_property_ids(database, params, watermark) == []
+
+    # One late reservation and one corrected one
+    database.execute(
+        "INSERT INTO reservation VALUES (20, 3, '2023-05-20', '2023-05-02')"
+    )
+    database.execute("UPDATE reservation SET created_at = '2023-06-03' WHERE id = 6")
+    changed = watermarks.changed_property_ids(database, params, watermark)
+    assert sorted(changed) == [1, 3]
+    database.close()
+
+
+def test_incremental_property_analytics_picks_up_late_reservations(tmp_path):
+    path = str(tmp_path / "test.duckdb")
+    with duckdb.connect(path) as conn:
+        conn.execute(
+            """
+            CREATE TABLE property AS
+            SELECT range AS id, 30.0 AS lat, -97.0 AS lon, range AS host_id,
+                'austin' AS market_name
+            FROM range(3);
+            CREATE TABLE guest AS
+            SELECT range AS id, 30.0 AS lat, -97.5 AS lon FROM range(100);
+            CREATE TABLE reservation AS
+            SELECT
+                range AS id,
+                range % 3 AS property_id,
+                TIMESTAMP '2023-05-10' AS start_date,
+                TIMESTAMP '2023-05-12' AS end_date,
+                range AS guest_id,
+                1000.0 AS total_cost,
+                TIMESTAMP '2023-04-01' AS created_at,
+                4.0 AS stars
+            FROM range(30)
+            """
+        )
+    resources = {
+        "io_manager": DuckDBPandasArrowIOManager(database=path, schema="main"),
+        "database": Database(path=path),
+    }
+    instance = DagsterInstance.ephemeral()
+
+    def run(selection, incremental=False):
+        config = {"incremental": incremental}
+        result = materialize(
+            [monthly_reservations, property_analytics],
+            selection=selection,
+            partition_key="2023-05-01",
+            resources=resources,
+            instance=instance,
+            run_config={"ops": {"property_analytics": {"config": config}}},
+        )
+        assert result.success
+        with duckdb.connect(path) as conn:
+            return conn.execute(
+                "SELECT sum(total_revenue) FROM property_analytics"
+            ).fetchone()[0]
+
+    assert run(["monthly_reservations", "property_analytics"]) == 30_000
+    # Arrives after the monthly_reservations snapshot was taken
+    with duckdb.connect(path) as conn:
+        conn.execute(
+            """
+            INSERT INTO reservation VALUES
+            (30, 1, '2023-05-20', '2023-05-22', 30, 500.0, '2023-05-19', NULL)
+            """
+        )
+    assert run(["property_analytics"]) == 30_000
+    assert run(["property_analytics"], incremental=True) == 30_500
+    assert run(["property_analytics"], incremental=True) == 30_500
+
+
+def test_monthly_reservations_are_written_batch_by_batch(tmp_path, monkeypatch):
+    path = str(tmp_path / "test.duckdb")
+    with duckdb.connect(path) as conn:
+        conn.execute(
+            """
+            CREATE TABLE property AS
+            SELECT range AS id, 30.0 AS lat, -97.0 AS lon, range AS host_id,
+                'austin' AS market_name
+            FROM range(50);
+            CREATE TABLE guest AS
+            SELECT range AS id, 30.0 AS lat, -97.5 AS lon FROM range(1000);
+            CREATE TABLE reservation AS
+            SELECT
+                range AS id,
+                (range * 7) % 50 AS property_id,
+                TIMESTAMP '2023-05-10' AS start_date,
+                TIMESTAMP '2023-05-12' AS end_date,
+                range AS guest_id,
+                100.0 AS total_cost,
+                TIMESTAMP '2023-04-01' AS created_at,
+                4.0 AS stars
+            FROM range(1000)
+            """
+        )
+    distance_rows = []
+
+    def counting_with_distance(reservations, bounds, distance_method):
+        distance_rows.append(reservations.num_rows)
+        return with_distance(reservations, bounds, distance_method)
+
+    monkeypatch.setattr("user_report.assets.with_distance", counting_with_distance)
+    result = materialize(
+        [monthly_reservations],
+        partition_key="2023-05-01",
+        resources={
+            "io_manager": DuckDBPandasArrowIOManager(database=path, schema="main"),
+            "database": Database(path=path),
+        },
+        run_config={"ops": {"monthly_reservations": {"config": {"batch_size": 64}}}},
+    )
+    assert result.success
+
+    # No more than one batch of the month is given distances at a time
+    assert sum(distance_rows) == 1000
+    assert max(distance_rows) <= 64
+    with duckdb.connect(path) as conn:
+        property_ids = conn.execute(
+            "SELECT property_id FROM monthly_reservations"
+        ).fetchall()
+    assert [p for p, in property_ids] == sorted(i * 7 % 50 for i in range(1000))
+
+
+def test_property_analytics_in_database_matches_arrow(tmp_path):
+    path = str(tmp_path / "test.duckdb")
+    with duckdb.connect(path) as conn:
+        # Guests from 0 to 3 degrees north, so some are just inside and some
+        # just outside the local cutoff
+        conn.execute(
+            """
+            CREATE TABLE property AS
+            SELECT range AS id, 30.0 AS lat, -97.0 AS lon, range % 4 AS host_id,
+                'austin' AS market_name
+            FROM range(10);
+            CREATE TABLE guest AS
+            SELECT range AS id, 30.0 + range * 0.01 AS lat, -97.0 AS lon
+            FROM range(300);
+            CREATE TABLE reservation AS
+            SELECT
+                range AS id,
+                range % 10 AS property_id,
+                TIMESTAMP '2023-05-10' AS start_date,
+                TIMESTAMP '2023-05-10' + INTERVAL (range % 5) DAY AS end_date,
+                range AS guest_id,
+                100.0 + range AS total_cost,
+                TIMESTAMP '2023-04-01' AS created_at,
+                CASE WHEN range % 3 = 0 THEN NULL ELSE range % 5 + 1 END AS stars
+            FROM range(300)
+            """
+        )
+    resources = {
+        "io_manager": DuckDBPandasArrowIOManager(database=path, schema="main"),
+        "database": Database(path=path),
+    }
+
+    def run(config):
+        # The monthly_reservations snapshot is neither selected nor stored
+        materialize(
+            [monthly_reservations, property_analytics],
+            selection=["property_analytics"],
+            partition_key="2023-05-01",
+            resources=resources,
+            run_config={"ops": {"property_analytics": {"config": config}}},
+        )
+        with duckdb.connect(path) as conn:
+            return conn.execute(
+                "SELECT * FROM property_analytics ORDER BY property_id"
+            ).df()
+
+    # Uses haversine distances without being told
+    in_database = run({"compute_in_database": True})
+    arrow = run({"stream_batch_size": 64, "distance_method": "haversine"})
+    assert in_database["num_local_reservations"].sum() == 145
+    pd.testing.assert_frame_equal(in_database, arrow, check_dtype=False)
+    with duckdb.connect(path) as conn:
+        assert not conn.execute(
+            "SELECT * FROM information_schema.tables"
+            " WHERE table_name = 'monthly_reservations'"
+        ).fetchall()
+
+    with pytest.raises(Exception, match="haversine"):
+        run({"compute_in_database": True, "distance_method": "geodesic"})
+
+
+def test_market_analytics_loads_its_partition_as_arrow(tmp_path):
+    path = str(tmp_path / "test.duckdb")
+    with duckdb.connect(path) as conn:
+        # Two months of stored property_analytics, month_end is the end of the
+        # month a row belongs to
+        conn.execute(
+            """
+            CREATE TABLE property_analytics AS
+            SELECT
+                range AS property_id,
+                range AS host_id,
+                CASE WHEN range % 2 = 0 THEN 'austin' ELSE 'denver' END
+                    AS market_name,
+                CASE WHEN range < 10 THEN TIMESTAMPTZ '2023-06-01'
+                    ELSE TIMESTAMPTZ '2023-07-01' END AS month_end,
+                1000.0 * (range + 1) AS total_revenue,
+                0.5 AS occupancy_rate,
+                CASE WHEN range % 3 = 0 THEN NULL ELSE 4.0 END AS stars
+            FROM range(25)
+            """
+        )
+    result = materialize(
+        [property_analytics, market_analytics],
+        selection=["market_analytics"],
+        partition_key="2023-05-01",
+        resources={
+            "io_manager": DuckDBPandasArrowIOManager(database=path, schema="main"),
+            "database": Database(path=path),
+        },
+    )
+    # market_rollup only takes Arrow tables
+    assert result.success
+
+    with duckdb.connect(path) as conn:
+        rows = conn.execute(
+            """
+            SELECT market_name, metric, count FROM market_analytics
+            ORDER BY market_name, metric
+            """
+        ).fetchall()
+    # Only May's ten properties, the June rows are filtered out by the select
+    assert rows == [
+        ("austin", "occupancy_rate", 5),
+        ("austin", "stars", 3),
+        ("austin", "total_revenue", 5),
+        ("denver", "occupancy_rate", 5),
+        ("denver", "stars", 3),
+        ("denver", "total_revenue", 5),
+    ]
+
+
+def test_instrumentation_summarizes_spans():
+    recorder = instrumentation.Recorder()
+    token = instrumentation._recorder.set(recorder)
+    try:
+        for _ in range(10):
+            with instrumentation.span("storage_write", bytes=100):
+                pass
+        instrumentation.record("chart_render", 0.5)
+    finally:
+        instrumentation._recorder.reset(token)
+    # Outside of an instrumented asset nothing is recorded
+    instrumentation.record("chart_render", 1.0)
+
+    summary = recorder.summary()
+    assert summary["storage_write_ms"]["count"] == 10
+    assert summary["storage_write_bytes"] == 1000
+    assert summary["chart_render_ms"]["max"] == 500.0
+
+
+def test_lite_chart_layout_matches_matplotlib():
+    property_data = pd.DataFrame(
+        {
+            "month_end": pd.date_range("2023-04-01", periods=5, freq="MS", tz="UTC"),
+            "total_revenue": [1234500.0, 2345600.0, 1850000.0, 2900000.0, 2600000.0],
+        }
+    )
+    with LineChartRenderer("total_revenue") as renderer:
+        renderer.render(property_data)
+        y_low, y_high = renderer.ax.get_ylim()
+        y_ticks = [t for t in renderer.ax.get_yticks() if y_low <= t <= y_high]
+
+    layout = charts_lite.ChartLayout(property_data, "total_revenue")
+    assert (layout.y_low, layout.y_high) == pytest.approx((y_low, y_high))
+    assert [layout.y(t) for t in y_ticks] == pytest.approx(
+        [y for y, _ in layout.y_ticks]
+    )
+    assert len(layout.x_ticks) == 5
+
+    for backend in ["pillow", "svg"]:
+        assert charts.draw_line_chart(property_data, "total_revenue", backend).read()
+
+
+def test_render_pool_keeps_job_order_and_isolates_failures():
+    property_data = pd.DataFrame(
+        {
+            "month_end": pd.date_range("2023-04-01", periods=5, freq="MS", tz="UTC"),
+            "total_revenue": [1234500.0, 2345600.0, 1850000.0, 2900000.0, 2600000.0],
+        }
+    )
+    # Property 7 asks for a metric its data doesn't have
+    jobs = (
+        (
+            [(property_id, "total_revenue"), (property_id, "stars")],
+            property_data,
+            ["total_revenue", "stars" if property_id == 7 else "total_revenue"],
+        )
+        for property_id in range(20)
+    )
+    results = list(
+        charts.render_line_charts(jobs, max_workers=2, chunksize=3, backend="pillow")
+    )
+
+    assert [key for key, _, _ in results] == [
+        (property_id, chart_type)
+        for property_id in range(20)
+        for chart_type in ["total_revenue", "stars"]
+    ]
+    failed = [key for key, image, error in results if error is not None]
+    assert failed == [(7, "stars")]
+    assert all(image for key, image, _ in results if key not in failed)
+
+
+@pytest.mark.skipif(
+    not os.path.exists("/proc/self/statm"), reason="reads RSS from /proc"
+)
+def test_render_pool_memory_stays_flat():
+    property_data = pd.DataFrame(
+        {
+            "month_end": pd.date_range("2023-04-01", periods=5, freq="MS", tz="UTC"),
+            "total_revenue": [1234500.0, 2345600.0, 1850000.0, 2900000.0, 2600000.0],
+        }
+    )
+
+    def rss_mb():
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+    jobs = (
+        ([(property_id, "total_revenue")], property_data, ["total_revenue"])
+        for property_id in range(300)
+    )
+    results = charts.render_line_charts(jobs, backend="pillow")
+    for _ in itertools.islice(results, 50):
+        pass
+    warm = rss_mb()
+    # Each chart is a few MB of raster before it's encoded, so a leaked
+    # image or renderer per chart would grow well past the tolerance
+    assert sum(1 for _ in results) == 250
+    assert rss_mb() - warm < 20
+    # The renderers are closed once rendering ends
+    assert not charts._renderers
+
+
+def test_code_location_import_is_lightweight():
+    # Heavy dependencies are only imported once an asset runs
+    heavy = ["pandas", "numpy", "pyarrow", "matplotlib", "PIL", "seaborn", "geopy"]
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, user_report; "
+            f"print([m for m in {heavy!r} if m in sys.modules])",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == "[]"